@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import booko
+import contextlib
+import json
+import models
+import os
+import random
+import tempfile
+import threading
+import time
+
+
+from book_apis import GoodreadsApi, GoogleBooksApi, OpenLibraryApi
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http_transport import Transport
+from metrics import percentile
+from models import Book, Rating, Shelf
+from sqlalchemy import insert
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+
+def fake_isbn(i):
+  return f"978{i:010d}"
+
+
+# Responses shaped like the ones recorded from each provider. Half of the
+# Google Books results have no thumbnail, so enrichment fallbacks get exercised.
+def google_volume(isbn):
+  volume_info = {
+      "title": f"Book {isbn}",
+      "authors": ["Author"],
+      "language": "en",
+      "industryIdentifiers": [{"type": "ISBN_13", "identifier": isbn}],
+      "publishedDate": "2000",
+  }
+  if int(isbn) % 2:
+    volume_info["imageLinks"] = {"thumbnail": f"http://books.google.com/{isbn}.jpg"}
+  return {"selfLink": f"https://www.googleapis.com/books/v1/volumes/{isbn}", "volumeInfo": volume_info}
+
+
+def google_volumes(params):
+  query = params["q"][0]
+  if query.startswith("isbn:"):
+    isbns = [term.removeprefix("isbn:") for term in query.split(" OR ")]
+  else:
+    isbns = [fake_isbn(random.randrange(10**9)) for _ in range(int(params.get("maxResults", ["10"])[0]))]
+  return 200, {}, {"totalItems": len(isbns), "items": [google_volume(isbn) for isbn in isbns]}
+
+
+def open_library_search(params):
+  docs = [{
+      "key": f"/works/OL{i}W",
+      "title": params.get("title", [""])[0],
+      "author_name": [params.get("author", [""])[0]],
+      "isbn": [fake_isbn(i)],
+      "id_goodreads": [str(i)],
+  } for i in range(10)]
+  return 200, {}, {"numFound": len(docs), "docs": docs}
+
+
+def open_library_books(params):
+  data = {}
+  for key in params["bibkeys"][0].split(","):
+    isbn = key.removeprefix("ISBN:")
+    data[key] = {"details": {
+        "key": f"/books/OL{isbn}M",
+        "title": f"Book {isbn}",
+        "authors": [{"name": "Author"}],
+        "identifiers": {"goodreads": [isbn]},
+    }}
+  return 200, {}, data
+
+
+def goodreads_search(params):
+  return 302, {"Location": f"https://www.goodreads.com/book/show/{params['q'][0]}"}, None
+
+
+ROUTES = {
+    "/books/v1/volumes": google_volumes,
+    "/search.json": open_library_search,
+    "/api/books": open_library_books,
+    "/search": goodreads_search,
+}
+
+
+# Stands in for Google Books, Open Library and Goodreads. Every response is
+# delayed by the injected latency, plus up to as much again of jitter.
+class StubHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def do_GET(self):
+    url = urlsplit(self.path)
+    time.sleep(self.server.latency * (1 + random.random()))
+
+    if url.path in self.server.recordings:
+      status, headers, body = 200, {}, self.server.recordings[url.path]
+    elif url.path in ROUTES:
+      status, headers, body = ROUTES[url.path](parse_qs(url.query))
+    else:
+      status, headers, body = 404, {}, {"error": "not found"}
+
+    payload = json.dumps(body).encode() if body is not None else b""
+    self.send_response(status)
+    for k, v in headers.items():
+      self.send_header(k, v)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class StubServer:
+  def __init__(self, latency=0.0, recordings=None):
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    self.server.daemon_threads = True
+    self.server.latency = latency
+    self.server.recordings = recordings or {}
+    self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+  def __enter__(self):
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+class FakeMember:
+  def __init__(self, user_id):
+    self.id = user_id
+    self.name = f"user{user_id}"
+    self.discriminator = "0001"
+    self.mention = f"<@{user_id}>"
+    self.display_avatar = SimpleNamespace(url=f"https://cdn.discordapp.com/avatars/{user_id}.png")
+
+
+class FakeGuild:
+  id = 0
+  name = "benchmark"
+
+  async def query_members(self, user_ids, cache=True):
+    return [FakeMember(user_id) for user_id in user_ids]
+
+
+class FakeResponse:
+  def is_done(self):
+    return True
+
+
+class FakeInteraction:
+  def __init__(self, user_id, guild):
+    self.user = FakeMember(user_id)
+    self.guild = guild
+    self.channel_id = 0
+    self.response = FakeResponse()
+
+  async def edit_original_message(self, **kwargs):
+    pass
+
+
+class FakeTree:
+  def get_commands(self, guild=None):
+    return []
+
+  async def sync(self, guild=None):
+    pass
+
+
+class FakeBot:
+  def __init__(self):
+    self.guild = FakeGuild()
+    self.tree = FakeTree()
+
+  def get_channel(self, channel_id):
+    return SimpleNamespace(id=channel_id)
+
+  def get_guild(self, guild_id):
+    return self.guild
+
+
+def report(name, latencies, elapsed):
+  latencies.sort()
+  print(
+      f"{name:<28} n={len(latencies):<6} "
+      f"p50={percentile(latencies, .5) * 1000:8.2f}ms "
+      f"p95={percentile(latencies, .95) * 1000:8.2f}ms "
+      f"p99={percentile(latencies, .99) * 1000:8.2f}ms "
+      f"{len(latencies) / elapsed:10.1f} ops/s")
+
+
+# Times every call of fn, running `concurrency` calls at a time.
+async def measure(name, fn, iterations, concurrency=1):
+  latencies = []
+
+  async def timed():
+    start = time.perf_counter()
+    await fn()
+    latencies.append(time.perf_counter() - start)
+
+  start = time.perf_counter()
+  for i in range(0, iterations, concurrency):
+    await asyncio.gather(*(timed() for _ in range(min(concurrency, iterations - i))))
+  report(name, latencies, time.perf_counter() - start)
+
+
+# Fills a fresh database with `size` read books, each with a few ratings.
+def build_library(path, size):
+  models.initialize(path)
+  booko.AsyncSession = models.AsyncSession
+  with models.Session() as session:
+    books = [{
+        "id": i,
+        "title": f"Book {i}",
+        "author": "Author",
+        "isbn": fake_isbn(i),
+        "shelf": Shelf.READ,
+        "message_id": i,
+        "user_id": i % 100,
+    } for i in range(1, size + 1)]
+    session.execute(insert(Book), books)
+    ratings = [
+        {"user_id": user_id, "book_id": i, "rating": random.randint(1, 5)}
+        for i in range(1, size + 1) for user_id in random.sample(range(1000), 3)]
+    session.execute(insert(Rating), ratings)
+    session.commit()
+
+
+async def bench_search(stub, args):
+  # Measure the bot rather than the providers' rate limits.
+  transport = Transport(rate_limits={})
+  cog = booko.BookoCog(
+      FakeBot(),
+      GoogleBooksApi(None, False, transport=transport, base_url=stub.url),
+      OpenLibraryApi(False, transport=transport, base_url=stub.url, goodreads_base_url=stub.url),
+      GoodreadsApi(False, transport, base_url=stub.url),
+      args.max_concurrency)
+
+  # What /add_book waits for before showing a match: the first results, and
+  # the shown book's links and thumbnail.
+  async def first_match():
+    async with contextlib.aclosing(cog.search_books("Author", "Title", Shelf.READ, 1)) as results:
+      async for books, _ in results:
+        await cog.enrich_book(books[0])
+        return
+
+  # Every result, unenriched, as BookChoice receives them.
+  async def search():
+    async with contextlib.aclosing(cog.search_books("Author", "Title", Shelf.READ, 1)) as results:
+      async for _ in results:
+        pass
+
+  await measure("first_match", first_match, args.iterations, args.concurrency)
+  await measure("search", search, args.iterations, args.concurrency)
+
+
+async def bench_library(size, args):
+  guild = FakeGuild()
+
+  async def rate():
+    book_id = random.randint(1, size)
+    view = booko.FinalizedBook(book_id, Shelf.READ)
+    itx = FakeInteraction(random.randrange(1000), guild)
+    # The interaction router remembers every user it sees.
+    booko.member_directory.remember(itx.user)
+    await view.apply_ratings([(itx, random.randint(1, 5))])
+
+  async def restart():
+    cog = booko.BookoCog(FakeBot(), None, None, None)
+    await cog.on_ready()
+
+  await measure(f"handle_rating ({size} books)", rate, args.iterations, args.concurrency)
+  await measure(f"on_ready ({size} books)", restart, args.iterations)
+
+
+async def main():
+  parser = argparse.ArgumentParser(
+      description="Benchmarks the bot against a local stand-in for the book APIs.")
+  parser.add_argument(
+      "--latency", type=float, default=0.05, help="Seconds of latency to inject per API request.")
+  parser.add_argument(
+      "--recordings", help="A JSON file mapping API paths to recorded response bodies.")
+  parser.add_argument(
+      "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="Library sizes to test.")
+  parser.add_argument("--iterations", type=int, default=200)
+  parser.add_argument("--concurrency", type=int, default=1)
+  parser.add_argument("--max_concurrency", type=int, default=8)
+  args = parser.parse_args()
+
+  recordings = None
+  if args.recordings:
+    with open(args.recordings, "r") as f:
+      recordings = json.load(f)
+
+  with StubServer(args.latency, recordings) as stub, tempfile.TemporaryDirectory() as tmp:
+    # Searches don't touch the library, but the bot needs a database.
+    build_library(os.path.join(tmp, "empty.db"), 0)
+    await bench_search(stub, args)
+    for size in args.sizes:
+      build_library(os.path.join(tmp, f"library_{size}.db"), size)
+      await bench_library(size, args)
+
+
+if __name__ == "__main__":
+  asyncio.run(main())
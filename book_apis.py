@@ -1,13 +1,44 @@
+import asyncio
 import json
 import models
-import requests
+import re
 import traceback
 
 
+from concurrent import futures
+from http_transport import Transport
 from pprint import pprint
 
 
+def to_isbn13(isbn) -> str:
+  isbn = str(isbn).replace("-", "").strip().upper()
+  if len(isbn) != 10:
+    return isbn
+  # Prefix with 978 and recompute the check digit.
+  digits = "978" + isbn[:9]
+  total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+  return digits + str(-total % 10)
+
+
+# Lowercases text and drops punctuation, for comparing titles and authors.
+def normalize(text: str) -> str:
+  return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def chunks(items, size):
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
+
+
 class BaseApi:
+  # Identifies the provider, e.g. in cache keys.
+  name = None
+  # The most ISBNs search_isbns() looks up per request.
+  max_batch_size = 1
+  # Whether link_from_isbn() and thumbnail_from_isbn() just build URLs, without
+  # making requests. Such lookups aren't worth caching or a worker thread.
+  builds_links = False
+
   def link_from_isbn(self, isbn):
     raise NotImplementedError("link_from_isbn() is unimplemented.")
 
@@ -20,15 +51,74 @@ class BaseApi:
   def search_isbn(self, isbn: int) -> models.Book:
     raise NotImplementedError("search_isbn() is unimplemented.")
 
+  # Maps each ISBN that was found to its book. ISBNs the provider is sure it
+  # doesn't have are added to `missing`, if given; others may just have been
+  # cut off, e.g. by a cap on results. By default this looks the ISBNs up one
+  # by one; providers that can batch lookups override it.
+  def search_isbns(self, isbns, missing: set = None) -> dict[str, models.Book]:
+    books = {}
+    for isbn in isbns:
+      try:
+        books[str(isbn)] = self.search_isbn(isbn)
+      except ValueError:
+        if missing is not None:
+          missing.add(str(isbn))
+    return books
+
+  # Drops any cached result of method(*args), e.g. a link found to be broken.
+  def forget(self, method, *args):
+    pass
+
+
+# Runs a BaseApi's blocking calls on worker threads so they don't stall the
+# event loop, with at most max_concurrency calls in flight. Each AsyncApi has
+# its own threads: calls sleep on their provider's rate limit inside them, so a
+# throttled provider would otherwise tie up the threads other providers need.
+class AsyncApi:
+  def __init__(self, api: BaseApi, max_concurrency=8):
+    self.api = api
+    self.semaphore = asyncio.Semaphore(max_concurrency)
+    self.executor = futures.ThreadPoolExecutor(max_concurrency)
+
+  async def _call(self, fn, *args):
+    async with self.semaphore:
+      return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+  async def link_from_isbn(self, isbn):
+    if self.api.builds_links:
+      return self.api.link_from_isbn(isbn)
+    return await self._call(self.api.link_from_isbn, isbn)
+
+  async def thumbnail_from_isbn(self, isbn):
+    if self.api.builds_links:
+      return self.api.thumbnail_from_isbn(isbn)
+    return await self._call(self.api.thumbnail_from_isbn, isbn)
+
+  async def search_author_title(self, author: str, title: str) -> list[models.Book]:
+    return await self._call(self.api.search_author_title, author, title)
+
+  async def search_isbn(self, isbn: int) -> models.Book:
+    return await self._call(self.api.search_isbn, isbn)
+
+  async def search_isbns(self, isbns) -> dict[str, models.Book]:
+    return await self._call(self.api.search_isbns, isbns)
+
+  async def forget(self, method, *args):
+    await asyncio.to_thread(self.api.forget, method, *args)
+
 
 class GoodreadsApi(BaseApi):
-  def __init__(self, verbose):
+  name = "goodreads"
+
+  def __init__(self, verbose, transport=None, base_url="https://www.goodreads.com"):
     self.verbose = verbose
+    self.transport = transport or Transport()
+    self.base_url = base_url
 
   def link_from_isbn(self, isbn):
-    url = "https://www.goodreads.com/search"
+    url = f"{self.base_url}/search"
     params = {"q": isbn, "ref": "nav_sb_noss_l_13"}
-    r = requests.get(url, params, allow_redirects=False)
+    r = self.transport.get(url, params, provider=self.name, allow_redirects=False)
     if self.verbose:
       print(f"{r}")
       print(f"{r.text}")
@@ -40,8 +130,19 @@ class GoodreadsApi(BaseApi):
 
 
 class OpenLibraryApi(BaseApi):
-  def __init__(self, verbose):
+  name = "open_library"
+  max_batch_size = 50
+  builds_links = True
+
+  def __init__(
+      self, verbose, max_results=10, transport=None, base_url="https://openlibrary.org",
+      goodreads_base_url="https://www.goodreads.com"):
     self.verbose = verbose
+    self.max_results = max_results
+    self.transport = transport or Transport()
+    self.base_url = base_url
+    # Used as a fallback to find Goodreads links.
+    self.goodreads_api = GoodreadsApi(verbose, self.transport, base_url=goodreads_base_url)
 
   def link_from_isbn(self, isbn):
     return f"https://openlibrary.org/isbn/{isbn}"
@@ -50,9 +151,14 @@ class OpenLibraryApi(BaseApi):
     return f"https://covers.openlibrary.org/b/isbn/{isbn}-M.jpg"
 
   def search_author_title(self, author: str, title: str) -> list[models.Book]:
-    url = f"http://openlibrary.org/search.json"
-    params = {"author": author, "title": title}
-    r = requests.get(url, params)
+    url = f"{self.base_url}/search.json"
+    params = {
+        "author": author,
+        "title": title,
+        "fields": "key,title,author_name,isbn,id_goodreads",
+        "limit": self.max_results,
+    }
+    r = self.transport.get(url, params, provider=self.name)
 
     data = r.json()
     if self.verbose:
@@ -66,11 +172,14 @@ class OpenLibraryApi(BaseApi):
         book.title = doc["title"]
         book.author = ", ".join(doc["author_name"])
 
-        book.isbn, = doc["isbn"]
+        # A work lists the ISBNs of all of its editions; prefer an ISBN-13.
+        isbns = doc["isbn"]
+        book.isbn = next((isbn for isbn in isbns if len(isbn) == 13), isbns[0])
 
         book.open_library_url = f"https://openlibrary.org{doc['key']}"
-        book.goodreads_url = self.__find_goodreads_url(doc, book.isbn)
-        thumbnail_url = self.thumbnail_from_isbn(isbn)
+        # Don't query Goodreads for every result; enrichment fills in the rest.
+        book.goodreads_url = self.__find_goodreads_url(doc, book.isbn, fallback=False)
+        book.thumbnail_url = self.thumbnail_from_isbn(book.isbn)
 
         books.append(book)
       except (KeyError, IndexError, ValueError) as e:
@@ -79,33 +188,53 @@ class OpenLibraryApi(BaseApi):
     return books
 
   def search_isbn(self, isbn: int) -> models.Book:
-    url = f"https://openlibrary.org/api/books"
-    key = f"ISBN:{isbn}"
-    params = {"bibkeys": key, "jscmd": "details", "format": "json"}
-    r = requests.get(url, params)
-
-    data = r.json()
-    if self.verbose:
-      print(json.dumps(data, indent=4))
-
-    if not data or key not in data:
+    books = self.search_isbns([isbn])
+    if str(isbn) not in books:
       raise ValueError(f"No book found for ISBN {isbn}.")
+    return books[str(isbn)]
+
+  def search_isbns(self, isbns, missing: set = None) -> dict[str, models.Book]:
+    url = f"{self.base_url}/api/books"
+    books = {}
+    # The books API takes a comma separated list of bibkeys.
+    for chunk in chunks([str(isbn) for isbn in isbns], self.max_batch_size):
+      params = {
+          "bibkeys": ",".join(f"ISBN:{isbn}" for isbn in chunk),
+          "jscmd": "details",
+          "format": "json"
+      }
+      r = self.transport.get(url, params, provider=self.name)
+
+      data = r.json()
+      if self.verbose:
+        print(json.dumps(data, indent=4))
 
-    details = data[key]["details"]
+      for isbn in chunk:
+        key = f"ISBN:{isbn}"
+        if key not in data:
+          # The books API returns every bibkey it knows.
+          if missing is not None:
+            missing.add(isbn)
+          continue
+        details = data[key]["details"]
 
-    book = models.Book()
-    book.author = ", ".join(author["name"] for author in details["authors"])
-    book.title = details["title"]
-    book.isbn = isbn
+        book = models.Book()
+        book.author = ", ".join(author["name"] for author in details["authors"])
+        book.title = details["title"]
+        book.isbn = isbn
 
-    book.open_library_url = f'https://openlibrary.org{details["key"]}'
-    book.goodreads_url = self.__find_goodreads_url(details, isbn)
-    book.thumbnail_url = self.thumbnail_from_isbn(isbn)
+        book.open_library_url = f'https://openlibrary.org{details["key"]}'
+        # A Goodreads request per ISBN would undo the batching; enrichment
+        # fills in the rest.
+        book.goodreads_url = self.__find_goodreads_url(details, isbn, fallback=False)
+        book.thumbnail_url = self.thumbnail_from_isbn(isbn)
+        books[isbn] = book
 
-    return book
+    return books
 
+  def __find_goodreads_url(self, data, isbn, fallback=True):
+    goodreads_id = None
 
-  def __find_goodreads_url(self, data, isbn):
     # find_by_author_title case: data is a doc
     try:
       goodreads_id = data["id_goodreads"][0]
@@ -120,51 +249,106 @@ class OpenLibraryApi(BaseApi):
 
     if goodreads_id is not None:
       return f"https://www.goodreads.com/book/show/{goodreads_id}"
+    if not fallback:
+      return None
 
     # Last ditched effort, try querying Goodreads with the ISBN.
-    return GoodreadsApi(self.verbose).link_from_isbn(isbn)
+    return self.goodreads_api.link_from_isbn(isbn)
 
 
 class GoogleBooksApi(BaseApi):
-  def __init__(self, key, verbose, max_results=10):
+  name = "google_books"
+  # Google Books returns at most 40 results per request.
+  max_batch_size = 40
+
+  # Only request the parts of each volume that __parse_response reads.
+  SEARCH_FIELDS = (
+      "totalItems,items(selfLink,volumeInfo("
+      "title,authors,language,industryIdentifiers,imageLinks,publishedDate))")
+
+  def __init__(self, key, verbose, max_results=10, transport=None, base_url="https://www.googleapis.com"):
     self.key = key
     self.verbose = verbose
     self.max_results = max_results
+    self.transport = transport or Transport()
+    self.base_url = base_url
 
   def thumbnail_from_isbn(self, isbn):
-    url = "https://www.googleapis.com/books/v1/volumes"
+    url = f"{self.base_url}/books/v1/volumes"
     params = {
         "q": f"isbn:{isbn}",
-        "maxResults": {self.max_results},
+        "maxResults": 1,
         "printType": "books",
-        "orderBy": "relevance"
+        "orderBy": "relevance",
+        "fields": "items(volumeInfo/imageLinks)",
     }
-    r = requests.get(url, params)
+    r = self.transport.get(url, params, provider=self.name)
     data = r.json()
     try:
       image_links = data["items"][0]["volumeInfo"]["imageLinks"]
       return image_links.get("thumbnail", image_links.get("smallThumbnail", None))
-    except:
+    except (KeyError, IndexError):
       print(f"No thumbnail found for {isbn}")
       return None
 
 
 
   def search_author_title(self, author, title):
-    url = "https://www.googleapis.com/books/v1/volumes"
+    url = f"{self.base_url}/books/v1/volumes"
     params = {
         "q": f"intitle:{title} inauthor:{author}",
-        "maxResults": {self.max_results},
+        "maxResults": self.max_results,
         "printType": "books",
-        "orderBy": "relevance"
+        "orderBy": "relevance",
+        "fields": self.SEARCH_FIELDS,
     }
-    r = requests.get(url, params)
+    r = self.transport.get(url, params, provider=self.name)
     data = r.json()
     if self.verbose:
       pprint(data)
 
     return self.__parse_response(data)
 
+  def search_isbn(self, isbn: int) -> models.Book:
+    books = self.search_isbns([isbn])
+    if str(isbn) not in books:
+      raise ValueError(f"No book found for ISBN {isbn}.")
+    return books[str(isbn)]
+
+  def search_isbns(self, isbns, missing: set = None) -> dict[str, models.Book]:
+    url = f"{self.base_url}/books/v1/volumes"
+    books = {}
+    for chunk in chunks([str(isbn) for isbn in isbns], self.max_batch_size):
+      params = {
+          "q": " OR ".join(f"isbn:{isbn}" for isbn in chunk),
+          "maxResults": self.max_batch_size,
+          "printType": "books",
+          "fields": self.SEARCH_FIELDS,
+      }
+      r = self.transport.get(url, params, provider=self.name)
+      data = r.json()
+      if self.verbose:
+        pprint(data)
+
+      # Results aren't in request order, so match them back up by ISBN-13.
+      requested = {to_isbn13(isbn): isbn for isbn in chunk}
+      for book in self.__parse_response(data):
+        isbn = requested.get(to_isbn13(book.isbn))
+        if isbn is not None and isbn not in books:
+          books[isbn] = book
+
+      # A full page of results may have cut off some of the ISBNs. Volumes that
+      # __parse_response skipped, e.g. in other languages, weren't missing.
+      items = data.get("items", [])
+      if missing is not None and len(items) < self.max_batch_size:
+        returned = {
+            to_isbn13(identifier["identifier"])
+            for item in items for identifier in item["volumeInfo"].get("industryIdentifiers", [])
+        }
+        missing.update(isbn for key, isbn in requested.items() if key not in returned)
+
+    return books
+
   def __parse_response(self, data) -> list[models.Book]:
     if data["totalItems"] == 0 or "items" not in data:
       return []
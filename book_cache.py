@@ -0,0 +1,307 @@
+import collections
+import json
+import metrics
+import models
+import requests
+import threading
+import time
+
+
+from book_apis import BaseApi
+from concurrent import futures
+from models import Book, CacheEntry
+from sqlalchemy import delete, func, select, update
+
+
+DAY = 24 * 60 * 60
+
+
+# A two tier cache for book API results. Entries live in the `api_cache` table
+# of the models database so that they are shared by the bot and the CLI, and
+# the most recently used entries are also kept in memory. `None` results are
+# cached too, but with a shorter TTL since a missing thumbnail or link may show
+# up later.
+class BookCache:
+  def __init__(
+      self, ttl=30*DAY, negative_ttl=DAY, memory_size=1024, max_entries=100_000, touch_batch=100,
+      touch_interval=60):
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.memory_size = memory_size
+    self.max_entries = max_entries
+    self.touch_batch = touch_batch
+    self.touch_interval = touch_interval
+
+    # key -> (expires_at, value), in least to most recently used order.
+    self.memory = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.puts_since_prune = 0
+    # key -> time of its latest hit, waiting to be written to accessed_at.
+    # Hits are written in batches rather than one commit per read.
+    self.touched = {}
+    self.touched_at = time.time()
+
+    self.memory_hits = 0
+    self.database_hits = 0
+    self.misses = 0
+
+  # Returns (True, value) on a hit and (False, None) on a miss.
+  def get(self, key):
+    now = time.time()
+    with self.lock:
+      if key in self.memory:
+        expires_at, value = self.memory[key]
+        if expires_at > now:
+          self.memory.move_to_end(key)
+          self.memory_hits += 1
+          self._touch(key, now)
+          return True, value
+        del self.memory[key]
+
+    with models.Session() as session:
+      entry = session.get(CacheEntry, key)
+      if entry is None or entry.expires_at <= now:
+        with self.lock:
+          self.misses += 1
+        return False, None
+      expires_at = entry.expires_at
+      value = json.loads(entry.value)
+
+    with self.lock:
+      self.database_hits += 1
+      self._remember(key, expires_at, value)
+      self._touch(key, now)
+    return True, value
+
+  # Like get(), but expired entries are hits too. Used when a provider can't
+  # be reached, since an old answer beats none.
+  def get_stale(self, key):
+    with self.lock:
+      if key in self.memory:
+        return True, self.memory[key][1]
+    with models.Session() as session:
+      entry = session.get(CacheEntry, key)
+      if entry is None:
+        return False, None
+      return True, json.loads(entry.value)
+
+  def put(self, key, value):
+    now = time.time()
+    expires_at = now + (self.negative_ttl if value is None else self.ttl)
+    with models.Session() as session:
+      session.merge(CacheEntry(
+          key=key, value=json.dumps(value), expires_at=expires_at, accessed_at=now))
+      session.commit()
+
+    with self.lock:
+      self._remember(key, expires_at, value)
+      self.puts_since_prune += 1
+      prune = self.puts_since_prune >= 100
+      if prune:
+        self.puts_since_prune = 0
+    if prune:
+      self.prune()
+
+  def delete(self, key):
+    with self.lock:
+      self.memory.pop(key, None)
+    with models.Session() as session:
+      session.execute(delete(CacheEntry).where(CacheEntry.key == key))
+      session.commit()
+
+  # Writes the pending hits to accessed_at.
+  def flush_touches(self):
+    with self.lock:
+      touched, self.touched = self.touched, {}
+      self.touched_at = time.time()
+    self._write_touches(touched)
+
+  def _write_touches(self, touched):
+    if not touched:
+      return
+    with models.Session() as session:
+      # Entries deleted in the meantime are skipped.
+      keys = set(session.execute(select(CacheEntry.key).where(CacheEntry.key.in_(touched))).scalars())
+      if keys:
+        session.execute(update(CacheEntry), [
+            {"key": key, "accessed_at": accessed_at} for key, accessed_at in touched.items() if key in keys
+        ])
+      session.commit()
+
+  # Drops expired entries, then the least recently used past max_entries.
+  def prune(self):
+    self.flush_touches()
+    with models.Session() as session:
+      session.execute(delete(CacheEntry).where(CacheEntry.expires_at <= time.time()))
+      count = session.execute(select(func.count()).select_from(CacheEntry)).scalar()
+      if count > self.max_entries:
+        oldest = (
+            select(CacheEntry.key)
+            .order_by(CacheEntry.accessed_at)
+            .limit(count - self.max_entries))
+        session.execute(delete(CacheEntry).where(CacheEntry.key.in_(oldest)))
+      session.commit()
+
+  def stats(self):
+    with self.lock:
+      return {
+          "memory_hits": self.memory_hits,
+          "database_hits": self.database_hits,
+          "misses": self.misses,
+      }
+
+  # Records a hit, flushing the pending hits once there are enough of them or
+  # they've waited long enough. Call with the lock held.
+  def _touch(self, key, now):
+    self.touched[key] = now
+    if len(self.touched) >= self.touch_batch or now - self.touched_at >= self.touch_interval:
+      touched, self.touched = self.touched, {}
+      self.touched_at = now
+      threading.Thread(target=self._write_touches, args=(touched,), daemon=True).start()
+
+  def _remember(self, key, expires_at, value):
+    self.memory[key] = (expires_at, value)
+    self.memory.move_to_end(key)
+    while len(self.memory) > self.memory_size:
+      self.memory.popitem(last=False)
+
+
+# Lets concurrent callers of the same lookup share a single call.
+class SingleFlight:
+  def __init__(self):
+    self.lock = threading.Lock()
+    # key -> Future of the call in flight.
+    self.calls = {}
+
+  # Returns fn(*args), or the result of the identical call already in flight.
+  # `labels` label the coalesced metric.
+  def do(self, key, labels, fn, *args):
+    with self.lock:
+      future = self.calls.get(key)
+      leader = future is None
+      if leader:
+        future = self.calls[key] = futures.Future()
+    if not leader:
+      metrics.api_coalesced.inc(**labels)
+      return future.result()
+
+    try:
+      result = fn(*args)
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    else:
+      future.set_result(result)
+      return result
+    finally:
+      with self.lock:
+        del self.calls[key]
+
+
+# Wraps a BaseApi so that its results are served from a BookCache. While the
+# provider is failing or its circuit breaker is open, expired entries are
+# served instead.
+class CachedApi(BaseApi):
+  def __init__(self, api: BaseApi, cache: BookCache):
+    self.api = api
+    self.cache = cache
+    self.name = api.name
+    self.builds_links = api.builds_links
+    self.flights = SingleFlight()
+
+  def link_from_isbn(self, isbn):
+    if self.builds_links:
+      return self.api.link_from_isbn(isbn)
+    return self._cached("link_from_isbn", (isbn,), self.api.link_from_isbn)
+
+  def thumbnail_from_isbn(self, isbn):
+    if self.builds_links:
+      return self.api.thumbnail_from_isbn(isbn)
+    return self._cached("thumbnail_from_isbn", (isbn,), self.api.thumbnail_from_isbn)
+
+  def search_author_title(self, author: str, title: str) -> list[Book]:
+    def search(author, title):
+      return [book.to_dict() for book in self.api.search_author_title(author, title)]
+    books = self._cached("search_author_title", (author, title), search)
+    return [Book.from_dict(d) for d in books]
+
+  def search_isbn(self, isbn: int) -> Book:
+    def search(isbn):
+      try:
+        return self.api.search_isbn(isbn).to_dict()
+      except ValueError:
+        return None
+    book = self._cached("search_isbn", (isbn,), search)
+    if book is None:
+      raise ValueError(f"No book found for ISBN {isbn}.")
+    return Book.from_dict(book)
+
+  # Serves what it can from the cache and batches the rest into one call.
+  def search_isbns(self, isbns, missing: set = None) -> dict[str, Book]:
+    books = {}
+    misses = []
+    for isbn in map(str, isbns):
+      hit, book = self.cache.get(self._key("search_isbn", (isbn,)))
+      if not hit:
+        misses.append(isbn)
+      elif book is not None:
+        books[isbn] = Book.from_dict(book)
+      elif missing is not None:
+        missing.add(isbn)
+
+    if misses:
+      misses.sort()
+      key = self._key("search_isbns", misses)
+      labels = {"provider": self.name, "method": "search_isbns"}
+      try:
+        found, not_found = self.flights.do(key, labels, self._search_isbns, misses)
+      except requests.RequestException:
+        stale = {isbn: self.cache.get_stale(self._key("search_isbn", (isbn,))) for isbn in misses}
+        if not any(hit for hit, _ in stale.values()):
+          raise
+        books.update({isbn: Book.from_dict(book) for isbn, (_, book) in stale.items() if book})
+        return books
+      books.update({isbn: Book.from_dict(book) for isbn, book in found.items()})
+      if missing is not None:
+        missing.update(not_found)
+    return books
+
+  # Looks up and caches the ISBNs, returning the books found as dicts so that
+  # coalesced callers don't share Book objects, and the ISBNs the provider is
+  # sure it doesn't have. Only those are cached as not found; the rest may just
+  # have been cut off.
+  def _search_isbns(self, isbns):
+    missing = set()
+    found = self.api.search_isbns(isbns, missing)
+    for isbn, book in found.items():
+      self.cache.put(self._key("search_isbn", (isbn,)), book.to_dict())
+    for isbn in missing:
+      self.cache.put(self._key("search_isbn", (isbn,)), None)
+    return {isbn: book.to_dict() for isbn, book in found.items()}, missing
+
+  def forget(self, method, *args):
+    self.cache.delete(self._key(method, args))
+
+  # Arguments are normalized so that e.g. "The Hobbit " and "the hobbit" share
+  # cache entries and in-flight calls.
+  def _key(self, method, args):
+    return json.dumps([self.name, method, *(" ".join(str(arg).split()).casefold() for arg in args)])
+
+  # Calls fn and caches its result, sharing the call with identical ones in flight.
+  def _fetch(self, key, fn, args):
+    value = fn(*args)
+    self.cache.put(key, value)
+    return value
+
+  def _cached(self, method, args, fn):
+    key = self._key(method, args)
+    hit, value = self.cache.get(key)
+    if hit:
+      return value
+    try:
+      return self.flights.do(key, {"provider": self.name, "method": method}, self._fetch, key, fn, args)
+    except requests.RequestException:
+      hit, value = self.cache.get_stale(key)
+      if not hit:
+        raise
+      return value
@@ -1,13 +1,121 @@
 import argparse
+import json
+import models
+import os
 import sys
+import time
+import traceback
+
+from concurrent import futures
 
 from book_apis import GoodreadsApi, GoogleBooksApi, OpenLibraryApi
+from book_cache import BookCache, CachedApi
+from http_transport import Transport
+from metrics import percentile
+
+
+# Resolves one batch input line: either an ISBN or "title<TAB>author".
+def resolve(book_api, key):
+  start = time.perf_counter()
+  record = {"key": key}
+  try:
+    if "\t" in key:
+      title, author = key.split("\t", 1)
+      record["books"] = [book.to_dict() for book in book_api.search_author_title(author, title)]
+    else:
+      record["book"] = book_api.search_isbn(key).to_dict()
+  except ValueError as e:
+    # The book doesn't exist, which is a final answer rather than an error.
+    record["not_found"] = str(e)
+  except Exception as e:
+    traceback.print_exc()
+    record["error"] = repr(e)
+  return record, time.perf_counter() - start
+
+
+# Resolves each key from lines on a pool of workers, writing a JSONL record to
+# output as each one finishes. Keys in done are skipped. Returns the latencies.
+def run_batch(book_api, lines, output, done, workers):
+  latencies = []
+  with futures.ThreadPoolExecutor(workers) as executor:
+    pending = set()
+    for line in lines:
+      key = line.strip()
+      if not key or key in done:
+        continue
+      done.add(key)
+      # Only read ahead a little so huge inputs stream through.
+      if len(pending) >= 2 * workers:
+        finished, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        write_records(finished, output, latencies)
+      pending.add(executor.submit(resolve, book_api, key))
+    write_records(futures.as_completed(pending), output, latencies)
+  return latencies
+
+
+def write_records(finished, output, latencies):
+  for future in finished:
+    record, latency = future.result()
+    latencies.append(latency)
+    output.write(json.dumps(record) + "\n")
+    output.flush()
+
+
+# Returns the keys an earlier run resolved, so a resumed run can skip them.
+# Keys that failed are retried. An interrupted run may have left a partial last
+# line, which is ended so that new records start on a line of their own.
+def finished_keys(path):
+  done = set()
+  with open(path, "r") as f:
+    text = f.read()
+  for line in text.splitlines():
+    try:
+      record = json.loads(line)
+    except json.JSONDecodeError:
+      continue
+    if "error" not in record:
+      done.add(record["key"])
+  if text and not text.endswith("\n"):
+    with open(path, "a") as f:
+      f.write("\n")
+  return done
+
+
+def batch(book_api, args):
+  done = set()
+  if args.output != "-" and os.path.exists(args.output):
+    done = finished_keys(args.output)
+    print(f"Resuming after {len(done)} finished keys.", file=sys.stderr)
+
+  lines = sys.stdin if args.input == "-" else open(args.input, "r")
+  output = sys.stdout if args.output == "-" else open(args.output, "a")
+  start = time.perf_counter()
+  try:
+    latencies = run_batch(book_api, lines, output, done, args.workers)
+  finally:
+    if lines is not sys.stdin:
+      lines.close()
+    if output is not sys.stdout:
+      output.close()
+  elapsed = time.perf_counter() - start
+
+  latencies.sort()
+  print(
+      f"Resolved {len(latencies)} keys in {elapsed:.1f}s "
+      f"({len(latencies) / elapsed if elapsed else 0:.1f}/s); latency "
+      f"p50={percentile(latencies, .5):.3f}s "
+      f"p95={percentile(latencies, .95):.3f}s "
+      f"p99={percentile(latencies, .99):.3f}s",
+      file=sys.stderr)
+
 
 def main():
   parser = argparse.ArgumentParser()
 
   parser.add_argument("api", choices=["google_books", "open_library", "goodreads"])
   parser.add_argument("--google_books_api_key", default="data/books_api")
+  parser.add_argument("--database", default="data/test_alchemy.db", help="The SQLite database, or a database URL.")
+  parser.add_argument("--no_cache", dest="cache", action="store_false")
   subparsers = parser.add_subparsers(required=True, dest="command")
 
   title_parser = subparsers.add_parser("title")
@@ -23,21 +131,34 @@ def main():
   thumbnail_parser = subparsers.add_parser("thumbnail")
   thumbnail_parser.add_argument("isbn", type=int)
 
+  batch_parser = subparsers.add_parser(
+      "batch", help="Resolve ISBNs or tab separated title/author lines into JSONL.")
+  batch_parser.add_argument("input", nargs="?", default="-", help="Input file, or - for stdin.")
+  batch_parser.add_argument("-o", "--output", default="-", help="Output file, appended to and resumed from.")
+  batch_parser.add_argument("--workers", type=int, default=8)
+
   parser.add_argument("-v", "--verbose", dest="verbose", action="store_true")
   args = parser.parse_args()
 
+  transport = Transport()
   match args.api:
     case "google_books":
       with open(args.google_books_api_key, "r") as f:
         key = f.read().strip()
-      book_api = GoogleBooksApi(key, args.verbose)
+      book_api = GoogleBooksApi(key, args.verbose, transport=transport)
     case "open_library":
-      book_api = OpenLibraryApi(args.verbose)
+      book_api = OpenLibraryApi(args.verbose, transport=transport)
     case "goodreads":
-      book_api = GoodreadsApi(args.verbose)
+      book_api = GoodreadsApi(args.verbose, transport)
     case _:
       sys.exit(f"Unrecognized api: {args.api}")
 
+  cache = None
+  if args.cache:
+    models.initialize(args.database)
+    cache = BookCache()
+    book_api = CachedApi(book_api, cache)
+
   match args.command:
     case "title":
       print(book_api.search_author_title(args.author, args.title))
@@ -47,6 +168,14 @@ def main():
       print(book_api.link_from_isbn(args.isbn))
     case "thumbnail":
       print(book_api.thumbnail_from_isbn(args.isbn))
+    case "batch":
+      batch(book_api, args)
+
+  if cache:
+    cache.flush_touches()
+    print(f"API cache: {cache.stats()}", file=sys.stderr)
+  if args.verbose:
+    print(f"HTTP latency: {transport.stats()}", file=sys.stderr)
 
 
 if __name__ == "__main__":
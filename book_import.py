@@ -0,0 +1,214 @@
+import argparse
+import csv
+import itertools
+import json
+import models
+import os
+import sys
+import time
+import traceback
+
+from concurrent import futures
+
+from book_apis import GoodreadsApi, GoogleBooksApi, OpenLibraryApi, normalize, to_isbn13
+from book_cache import BookCache, CachedApi
+from http_transport import Transport
+from models import Book, ImportCheckpoint, Rating, Shelf
+from sqlalchemy import insert, select
+
+
+GOODREADS_SHELVES = {
+    "read": Shelf.READ,
+    "to-read": Shelf.RECOMMENDED,
+    "currently-reading": Shelf.RECOMMENDED,
+}
+
+
+# Goodreads exports ISBNs as spreadsheet formulas, e.g. ="0441172717".
+def goodreads_isbn(value):
+  return value.strip('="') or None
+
+
+# Yields a dict of Book columns, plus an optional "rating", per exported book.
+def read_goodreads_csv(f, shelf):
+  for row in csv.DictReader(f):
+    rating = int(row.get("My Rating") or 0)
+    yield {
+        "title": row["Title"],
+        "author": row["Author"],
+        "isbn": goodreads_isbn(row.get("ISBN13", "")) or goodreads_isbn(row.get("ISBN", "")),
+        "goodreads_url": f"https://www.goodreads.com/book/show/{row['Book Id']}",
+        "shelf": shelf or GOODREADS_SHELVES.get(row.get("Exclusive Shelf"), Shelf.RECOMMENDED),
+        "rating": rating or None,
+    }
+
+
+# Reads the output of `book_cli.py <api> batch`, taking the best match per key.
+def read_jsonl(f, shelf):
+  for line in f:
+    record = json.loads(line)
+    book = record.get("book") or next(iter(record.get("books", [])), None)
+    if book:
+      yield {**book, "shelf": shelf or Shelf.RECOMMENDED, "rating": None}
+    else:
+      print(f"Skipping {record['key']!r} with no match.", file=sys.stderr)
+      # Still yield a row so that row counts line up with the input.
+      yield None
+
+
+class Importer:
+  def __init__(self, google_books_api, open_library_api, goodreads_api, user_id, workers):
+    self.google_books_api = google_books_api
+    self.open_library_api = open_library_api
+    self.goodreads_api = goodreads_api
+    self.user_id = user_id
+    self.executor = futures.ThreadPoolExecutor(workers)
+    # The normalized (title, author) of every book in the library, loaded by
+    # run() and kept up to date as books are imported.
+    self.titles = set()
+
+  # Fills in ISBNs, thumbnails and links for the rows that are missing them.
+  def enrich(self, rows):
+    # Rows without an ISBN need a search, which also finds a thumbnail.
+    list(self.executor.map(self.find_isbn, [row for row in rows if not row["isbn"]]))
+
+    # Then all missing thumbnails are looked up in one batched request.
+    missing = [row for row in rows if row["isbn"] and not row.get("thumbnail_url")]
+    if missing:
+      try:
+        found = self.google_books_api.search_isbns([row["isbn"] for row in missing])
+      except Exception:
+        traceback.print_exc()
+        found = {}
+      for row in missing:
+        book = found.get(row["isbn"])
+        row["thumbnail_url"] = (
+            book and book.thumbnail_url or self.open_library_api.thumbnail_from_isbn(row["isbn"]))
+
+    list(self.executor.map(self.find_links, [row for row in rows if row["isbn"]]))
+
+  def find_isbn(self, row):
+    try:
+      books = self.google_books_api.search_author_title(row["author"], row["title"])
+    except Exception:
+      traceback.print_exc()
+      return
+    if books:
+      row["isbn"] = books[0].isbn
+      row["thumbnail_url"] = row.get("thumbnail_url") or books[0].thumbnail_url
+
+  def find_links(self, row):
+    try:
+      if not row.get("open_library_url"):
+        row["open_library_url"] = self.open_library_api.link_from_isbn(row["isbn"])
+      if not row.get("goodreads_url"):
+        row["goodreads_url"] = self.goodreads_api.link_from_isbn(row["isbn"])
+    except Exception:
+      traceback.print_exc()
+
+  # Drops the rows for books already in the library, or earlier in the import,
+  # matching by ISBN-13 or else by normalized title and author. Otherwise a
+  # renamed export, or one overlapping books added with /add_book, would add
+  # them again.
+  def new_rows(self, session, rows):
+    isbns = {row["isbn"] for row in rows if row["isbn"]}
+    isbns |= set(map(to_isbn13, isbns))
+    existing = set(map(to_isbn13, session.execute(select(Book.isbn).where(Book.isbn.in_(isbns))).scalars()))
+    new = []
+    for row in rows:
+      isbn = row["isbn"] and to_isbn13(row["isbn"])
+      title = (normalize(row["title"] or ""), normalize(row["author"] or ""))
+      if isbn in existing or title in self.titles:
+        continue
+      if isbn:
+        existing.add(isbn)
+      self.titles.add(title)
+      new.append(row)
+    if len(new) < len(rows):
+      print(f"Skipping {len(rows) - len(new)} books already in the library.", file=sys.stderr)
+    return new
+
+  # Inserts a batch of rows and advances the checkpoint in one transaction, so
+  # an interrupted import resumes right after the last finished batch.
+  def insert(self, source, batch, rows_done):
+    with models.Session() as session:
+      rows = self.new_rows(session, [row for row in batch if row])
+      if rows:
+        books = [{k: v for k, v in row.items() if k != "rating"} for row in rows]
+        book_ids = session.execute(
+            insert(Book).returning(Book.id, sort_by_parameter_order=True), books).scalars().all()
+        ratings = [
+            {"user_id": self.user_id, "book_id": book_id, "rating": row["rating"]}
+            for book_id, row in zip(book_ids, rows) if row["rating"] and self.user_id]
+        if ratings:
+          session.execute(insert(Rating), ratings)
+          changes = [(r["book_id"], r["user_id"], None, r["rating"]) for r in ratings]
+          for stmt, params in models.rating_stats_updates(changes):
+            session.execute(stmt, params)
+      session.merge(ImportCheckpoint(source=source, rows=rows_done + len(batch)))
+      session.commit()
+
+  def run(self, source, rows, batch_size, enrich):
+    with models.Session() as session:
+      checkpoint = session.get(ImportCheckpoint, source)
+      rows_done = checkpoint.rows if checkpoint else 0
+      self.titles = {
+          (normalize(title or ""), normalize(author or ""))
+          for title, author in session.execute(select(Book.title, Book.author))
+      }
+    if rows_done:
+      print(f"Resuming {source} after {rows_done} rows.", file=sys.stderr)
+
+    start = time.perf_counter()
+    imported = 0
+    rows = itertools.islice(rows, rows_done, None)
+    while batch := list(itertools.islice(rows, batch_size)):
+      if enrich:
+        self.enrich([row for row in batch if row])
+      self.insert(source, batch, rows_done)
+      rows_done += len(batch)
+      imported += len(batch)
+      elapsed = time.perf_counter() - start
+      print(f"Imported {rows_done} rows ({imported / elapsed:.1f}/s).", file=sys.stderr)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Imports a Goodreads CSV export, or book_cli batch JSONL, into the library.")
+  parser.add_argument("input", help="A Goodreads library export (.csv) or book_cli batch output (.jsonl).")
+  parser.add_argument("--database", default="data/test_alchemy.db", help="The SQLite database, or a database URL.")
+  parser.add_argument("--google_books_api_key", default="data/books_api")
+  parser.add_argument("--shelf", choices=[shelf.name for shelf in Shelf], help="Put every book on this shelf.")
+  parser.add_argument("--user_id", type=int, help="The Discord user to import Goodreads ratings for.")
+  parser.add_argument("--batch_size", type=int, default=1000)
+  parser.add_argument("--workers", type=int, default=8)
+  parser.add_argument("--no_enrich", dest="enrich", action="store_false")
+  parser.add_argument("-v", "--verbose", dest="verbose", action="store_true")
+  args = parser.parse_args()
+
+  models.initialize(args.database)
+
+  with open(args.google_books_api_key, "r") as f:
+    key = f.read().strip()
+  cache = BookCache()
+  transport = Transport()
+  importer = Importer(
+      CachedApi(GoogleBooksApi(key, args.verbose, transport=transport), cache),
+      CachedApi(OpenLibraryApi(args.verbose, transport=transport), cache),
+      CachedApi(GoodreadsApi(args.verbose, transport), cache),
+      args.user_id,
+      args.workers)
+
+  shelf = Shelf[args.shelf] if args.shelf else None
+  with open(args.input, "r", newline="") as f:
+    if args.input.endswith(".csv"):
+      rows = read_goodreads_csv(f, shelf)
+    else:
+      rows = read_jsonl(f, shelf)
+    importer.run(os.path.abspath(args.input), rows, args.batch_size, args.enrich)
+
+  print(f"API cache: {cache.stats()}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
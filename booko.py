@@ -1,18 +1,32 @@
 import argparse
 import asyncio
+import collections
 import config
+import contextlib
 import discord
+import hashlib
+import inspect
+import itertools
+import json
+import metrics
 import models
+import profiling
+import re
+import time
 import traceback
 
 
-from book_apis import GoodreadsApi, GoogleBooksApi, OpenLibraryApi
+from book_apis import AsyncApi, GoodreadsApi, GoogleBooksApi, OpenLibraryApi, normalize, to_isbn13
+from book_cache import BookCache, CachedApi
+from http_transport import Transport
+from members import MemberDirectory
 from discord import app_commands
 from discord import ui
 from discord.ext import commands
 from emoji import emojize
-from models import Shelf, Book, Rating
-from sqlalchemy import select
+from models import Shelf, Book
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.orm import selectinload
 
 
 # CONFIG = config.TEST_CONFIG
@@ -27,9 +41,19 @@ CANCEL_EMOJI = "❌"
 SUBMIT_EMOJI = "✅"
 STAR_EMOJI = "⭐"
 INVIS = "\u200b"
+RATING_EMOJIS = tuple(map(emojize, (
+    ":face_vomiting:",
+    ":nauseated_face:",
+    ":thinking_face:",
+    ":slightly_smiling_face:",
+    ":smiling_face_with_heart-eyes:"
+)))
+# Matches RatingButton custom ids, capturing the book id and rating value.
+RATING_CUSTOM_ID = re.compile(r"rating_button_(\d+)_(\d+)")
+ISBN = re.compile(r"(97[89])?\d{9}[\dX]")
 
 
-Session = None
+AsyncSession = None
 
 
 def check_channel(channel_map):
@@ -38,45 +62,133 @@ def check_channel(channel_map):
   return app_commands.check(predicate)
 
 
-def embed_from_book(book: Book, guild: discord.Guild):
-  embed = discord.Embed(
-      type="rich",
-      colour=discord.Colour.random())
-  # embed.set_footer(text=f"Use `/rate` to rate it!")
-  desc_map = {
-      "Title": f"*{book.title}*",
-      "Author": book.author,
-      "ISBN": book.isbn,
-      "Goodreads": book.goodreads_url,
-  }
-  description = "\n".join(f"**{k}:** {v}" for k, v in desc_map.items())
-  embed.description = description
-  embed.set_thumbnail(url=book.thumbnail_url)
-
-  # Add the user who recommended it, if available.
-  if book.user_id:
-    user = guild.get_member(book.user_id)
-    if not user:
-      print(f"Ignoring missing recommending user with id {book.user_id} for {book}")
+# The rendered parts of a book's embed. The book's details are rendered once;
+# after that only the rating of the user who changed it is re-rendered, and the
+# embed itself is only rebuilt after the ratings change. `version` counts those
+# changes, so callers can skip edits that wouldn't change the message. Users
+# are looked up in member_directory, so resolve them first.
+class BookRender:
+  def __init__(self, book: Book):
+    self.book_id = book.id
+    self.message_id = book.message_id
+    self.shelf = book.shelf
+    self.colour = discord.Colour.random()
+    desc_map = {
+        "Title": f"*{book.title}*",
+        "Author": book.author,
+        "ISBN": book.isbn,
+        "Goodreads": book.goodreads_url,
+    }
+    self.description = "\n".join(f"**{k}:** {v}" for k, v in desc_map.items())
+    self.thumbnail_url = book.thumbnail_url
+
+    # Add the user who recommended it, if available.
+    self.suggester = None
+    if book.user_id:
+      user = member_directory.get(book.user_id)
+      if not user:
+        print(f"Ignoring missing recommending user with id {book.user_id} for {book}")
+      else:
+        self.suggester = (user.display_name, user.avatar_url)
+
+    # Maps user id -> (mention, stars), in the order the ratings were made.
+    self.ratings = {}
+    self.version = 0
+    self._embed = None
+    # Books which haven't been added yet have no ratings to load.
+    if book.id is not None:
+      for rating in book.ratings:
+        self.set_rating(rating.user_id, rating.rating)
+
+  # Sets a user's rating, or removes it if value is None.
+  def set_rating(self, user_id: int, value: int):
+    stars = STAR_EMOJI*value if value else None
+    _, old = self.ratings.get(user_id, (None, None))
+    if old == stars:
+      return
+    if value is None:
+      del self.ratings[user_id]
+    elif user_id in self.ratings:
+      mention, _ = self.ratings[user_id]
+      self.ratings[user_id] = (mention, stars)
     else:
-      embed.set_author(name=f"{user.name}#{user.discriminator}", icon_url=user.avatar.url)
-
-  # This should be fine for now, but could be accessed without a session in the
-  # add book flow.
-  if book.ratings:
-    users = []
-    stars = []
-    for rating in book.ratings:
-      user = guild.get_member(rating.user_id)
+      user = member_directory.get(user_id)
       if not user:
-        print(f"Ignoring missing user with id {rating.user_id} for {book}")
-        continue
-      users.append(user.mention)
-      stars.append(STAR_EMOJI*rating.rating)
-    embed.add_field(name="User", value="\n".join(users))
-    embed.add_field(name="Rating", value="\n".join(stars))
-
-  return embed
+        print(f"Ignoring missing user with id {user_id} for book {self.book_id}")
+        return
+      self.ratings[user_id] = (user.mention, stars)
+    self.version += 1
+    self._embed = None
+
+  def embed(self) -> discord.Embed:
+    if self._embed:
+      return self._embed
+
+    embed = discord.Embed(type="rich", colour=self.colour)
+    # embed.set_footer(text=f"Use `/rate` to rate it!")
+    embed.description = self.description
+    embed.set_thumbnail(url=self.thumbnail_url)
+    if self.suggester:
+      name, icon_url = self.suggester
+      embed.set_author(name=name, icon_url=icon_url)
+    if self.ratings:
+      users, stars = zip(*self.ratings.values())
+      embed.add_field(name="User", value="\n".join(users))
+      embed.add_field(name="Rating", value="\n".join(stars))
+
+    self._embed = embed
+    return embed
+
+
+# The most recently used BookRenders, by book id.
+class RenderCache:
+  def __init__(self, size=512):
+    self.size = size
+    self.renders = collections.OrderedDict()
+
+  def get(self, book_id: int) -> BookRender:
+    render = self.renders.get(book_id)
+    if render:
+      self.renders.move_to_end(book_id)
+    return render
+
+  def drop(self, book_id: int):
+    self.renders.pop(book_id, None)
+
+  def put(self, render: BookRender):
+    self.renders[render.book_id] = render
+    self.renders.move_to_end(render.book_id)
+    while len(self.renders) > self.size:
+      self.renders.popitem(last=False)
+
+
+render_cache = RenderCache()
+member_directory = MemberDirectory()
+
+
+# The JSON a command is synced as. Newer discord.py versions build it from the
+# command tree.
+def command_payload(command, tree) -> dict:
+  if "tree" in inspect.signature(command.to_dict).parameters:
+    return command.to_dict(tree)
+  return command.to_dict()
+
+
+def embed_from_book(book: Book):
+  return BookRender(book).embed()
+
+
+# Returns the cached render of a book, loading the book and its users on a miss.
+async def load_render(book_id: int, guild: discord.Guild) -> BookRender:
+  render = render_cache.get(book_id)
+  if not render:
+    async with AsyncSession() as session:
+      stmt = select(Book).where(Book.id == book_id).options(selectinload(Book.ratings))
+      book = (await session.execute(stmt)).scalar()
+    await member_directory.resolve(guild, [book.user_id, *(rating.user_id for rating in book.ratings)])
+    render = BookRender(book)
+    render_cache.put(render)
+  return render
 
 
 class EditBookModal(ui.Modal):
@@ -97,6 +209,7 @@ class EditBookModal(ui.Modal):
   async def await_submit(self) -> tuple[discord.Interaction, Book]:
     return await self.book_response_queue.get()
 
+  @metrics.timed("edit_book_modal")
   async def on_submit(self, interaction: discord.Interaction):
     title, author, isbn, goodreads_url, thumbnail_url = self.children
     new_book = Book(
@@ -130,117 +243,439 @@ class RatingButton(ui.Button):
         custom_id=f"rating_button_{book_id}_{value}")
     self.value = value
 
-  async def callback(self, itx: discord.Interaction):
-    await self.view.handle_rating(itx, self.value)
+  # Clicks are routed by BookoCog.on_interaction from the custom id, so that no
+  # view has to stay registered for every book.
 
 
 class FinalizedBook(ui.View):
-  def __init__(self, book):
+  def __init__(self, book_id: int, shelf: Shelf):
     super().__init__(timeout=None)
 
-    self.book_id = book.id
-    if self.book_id is None:
-      with Session() as session:
-        session.add(book)
-        session.commit()
-        # We can now store the book id since it has been generated.
-        self.book_id = book.id
+    self.book_id = book_id
 
     # Only add ratings for past books.
-    if book.shelf == Shelf.READ:
-      emoji_names = (
-          ":face_vomiting:",
-          ":nauseated_face:",
-          ":thinking_face:",
-          ":slightly_smiling_face:",
-          ":smiling_face_with_heart-eyes:"
-      )
-      emojis = map(emojize, emoji_names)
-      for i, emoji in enumerate(emojis, 1):
+    if shelf == Shelf.READ:
+      for i, emoji in enumerate(RATING_EMOJIS, 1):
         self.add_item(RatingButton(self.book_id, i, emoji))
 
+  @classmethod
+  async def create(cls, book):
+    if book.id is None:
+      async with AsyncSession() as session:
+        session.add(book)
+        await session.commit()
+        # The book now has an id since it has been inserted.
+    return cls(book.id, book.shelf)
+
+  # Builds the view for a rating button click. Only past books have rating
+  # buttons, so the shelf is known without loading the book.
+  @classmethod
+  def from_rating_custom_id(cls, custom_id: str):
+    match = RATING_CUSTOM_ID.fullmatch(custom_id)
+    if not match:
+      return None, None
+    book_id, value = map(int, match.groups())
+    return cls(book_id, Shelf.READ), value
+
   async def send_message(self, itx: discord.Interaction):
-    with Session() as session:
-      stmt = select(Book).where(Book.id == self.book_id)
-      book = session.execute(stmt).scalar()
-      embed = embed_from_book(book, itx.guild)
-
-      # If the book doesn't have an id, that means this is the first time we're
-      # sending it. Use send_message(), and store the id.
-      # ip = f"is_persistent(): {self.is_persistent()}"
-      if book.message_id is None:
-        message = await itx.channel.send(embed=embed, view=self)
-        book.message_id = message.id
-        session.commit()
-        await itx.response.defer()
-        await asyncio.sleep(1)
-        await itx.delete_original_message()
-      else:
-        # Otherwise, just edit the existing message.
-        await itx.response.edit_message(embed=embed, view=self)
+    render = await load_render(self.book_id, itx.guild)
+    embed = render.embed()
+
+    # If the book doesn't have a message id, that means this is the first time
+    # we're sending it. Use send(), and store the id.
+    if render.message_id is None:
+      await itx.response.defer()
+      message = await itx.channel.send(embed=embed, view=self)
+      render.message_id = message.id
+      async with AsyncSession() as session:
+        await session.execute(
+            update(Book).where(Book.id == self.book_id).values(message_id=message.id))
+        await session.commit()
+      await asyncio.sleep(1)
+      await itx.delete_original_message()
+    elif itx.response.is_done():
+      await itx.edit_original_message(embed=embed, view=self)
+    else:
+      # Otherwise, just edit the existing message.
+      await itx.response.edit_message(embed=embed, view=self)
+    # The message now has the buttons; the view itself is no longer needed.
+    self.stop()
 
+  @metrics.timed("rating_button")
   async def handle_rating(self, itx: discord.Interaction, value: int):
-    user = itx.user
-    with Session() as session:
-      stmt = select(Rating).where(Rating.user_id == user.id).where(Rating.book_id == self.book_id)
-      rating = session.execute(stmt).scalar()
-      if not rating:
-        # Create a new rating if there isn't an existing.
-        rating = Rating(user_id=user.id, book_id=self.book_id)
-        session.add(rating)
-
-      # Delete the rating if it's the same as a prior, add the rating otherwise.
-      if rating.rating == value:
-        session.delete(rating)
-      else:
-        rating.rating = value
-      session.commit()
-    await self.send_message(itx)
+    with profiling.span("rating", book_id=self.book_id):
+      # Acknowledge the click right away so that it never waits on the database.
+      with profiling.span("defer"):
+        await itx.response.defer()
+      rating_coalescer.submit(self, itx, value)
+
+  # Applies a batch of (interaction, value) rating clicks in one transaction and
+  # edits the message once with the result.
+  @metrics.timed("rating_flush")
+  async def apply_ratings(self, clicks):
+    ratings = []
+    changes = []
+    with profiling.span("write", clicks=len(clicks)):
+      async with AsyncSession() as session:
+        for itx, value in clicks:
+          old = (await session.execute(models.select_rating(itx.user.id, self.book_id))).scalar()
+          upsert, cleanup = models.toggle_rating(itx.user.id, self.book_id, value)
+          new = (await session.execute(upsert)).scalar()
+          await session.execute(cleanup)
+          ratings.append((itx.user.id, new))
+          changes.append((self.book_id, itx.user.id, old, new))
+        # Keep the aggregates in step with the ratings in the same transaction.
+        for stmt, params in models.rating_stats_updates(changes):
+          await session.execute(stmt, params)
+        await session.commit()
+
+    # Patch a cached render rather than reloading the book and its ratings.
+    itx, _ = clicks[-1]
+    render = render_cache.get(self.book_id)
+    if render:
+      version = render.version
+      # Only each user's last rating in the batch shows.
+      for user_id, rating in dict(ratings).items():
+        render.set_rating(user_id, rating)
+      if render.version == version:
+        # E.g. a rating clicked twice; the message already shows the result.
+        return
+    with profiling.span("send"):
+      await self.send_message(itx)
+
+
+# Batches rating clicks per book. The first click on a book starts a window;
+# every click on it within the window is written in one transaction, followed
+# by a single edit of the book's message. Edits in a channel are also spaced at
+# least min_edit_interval apart to stay under Discord's edit rate limits.
+class RatingCoalescer:
+  def __init__(self, window=1.0, min_edit_interval=1.0):
+    self.window = window
+    self.min_edit_interval = min_edit_interval
+    # book id -> clicks waiting for the next flush.
+    self.pending = {}
+    # channel id -> loop time of the latest claimed flush.
+    self.last_flush = {}
+    self.tasks = set()
+
+  def submit(self, view: FinalizedBook, itx: discord.Interaction, value: int):
+    if view.book_id in self.pending:
+      self.pending[view.book_id].append((itx, value))
+      return
+    self.pending[view.book_id] = [(itx, value)]
+    task = asyncio.create_task(self.flush(view, itx.channel_id))
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+  async def flush(self, view: FinalizedBook, channel_id: int):
+    loop = asyncio.get_running_loop()
+    try:
+      # Keep flushing until no clicks came in during the last flush.
+      while self.pending[view.book_id]:
+        await asyncio.sleep(self.window)
+        # Claim the channel's next edit slot before sleeping, so that books
+        # flushing at the same time line up instead of editing together.
+        slot = max(loop.time(), self.last_flush.get(channel_id, 0) + self.min_edit_interval)
+        self.last_flush[channel_id] = slot
+        await asyncio.sleep(slot - loop.time())
+
+        clicks = self.pending[view.book_id]
+        self.pending[view.book_id] = []
+        try:
+          with profiling.span("rating_flush", book_id=view.book_id):
+            await view.apply_ratings(clicks)
+        except Exception as error:
+          traceback.print_exception(error)
+          for itx, _ in clicks:
+            await itx.followup.send(f"Error rating book: {str(error)}.", ephemeral=True)
+    finally:
+      # Otherwise later clicks on the book would wait on a flush that's gone.
+      del self.pending[view.book_id]
+
+
+rating_coalescer = RatingCoalescer()
+
+
+# Revalidates stored thumbnails and Goodreads links in the background. Books
+# come off a priority queue: recently viewed books first, then books missing
+# a field, then the least recently checked. Work only starts once no
+# interaction has been seen for quiet_period seconds, links are checked
+# through the rate limited "link_check" provider, and changes are written in
+# batches before the affected messages are edited.
+class RefreshWorker:
+  VIEWED, MISSING, STALE = 0, 1, 2
+
+  def __init__(
+      self, cog, transport: Transport, min_age=24*60*60, max_age=30*24*60*60, quiet_period=2.0,
+      batch_size=20, sweep_size=100, sweep_interval=60*60):
+    self.cog = cog
+    self.transport = transport
+    # Books are rechecked at most every min_age seconds, or every max_age
+    # seconds if they aren't missing anything.
+    self.min_age = min_age
+    self.max_age = max_age
+    self.quiet_period = quiet_period
+    self.batch_size = batch_size
+    self.sweep_size = sweep_size
+    self.sweep_interval = sweep_interval
+
+    # (priority, sequence, book id) entries. A book submitted again with a
+    # better priority leaves its old entry behind, which is skipped.
+    self.queue = asyncio.PriorityQueue()
+    self.queued = {}
+    self.sequence = itertools.count()
+    self.last_interaction = 0.0
+    # Book updates waiting to be written, and the books they change.
+    self.updates = []
+    self.changed = set()
+    self.task = None
+
+  def start(self):
+    self.task = asyncio.create_task(self.run())
+
+  # Notes interactive traffic, which the worker waits out.
+  def touch(self):
+    self.last_interaction = time.monotonic()
+
+  def submit(self, book_id: int, priority: int):
+    if self.queued.get(book_id, priority + 1) <= priority:
+      return
+    self.queued[book_id] = priority
+    self.queue.put_nowait((priority, next(self.sequence), book_id))
+
+  async def run(self):
+    await self.sweep()
+    while True:
+      try:
+        if self.queue.empty():
+          # Write out what's done before idling.
+          await self.flush()
+          try:
+            priority, _, book_id = await asyncio.wait_for(self.queue.get(), self.sweep_interval)
+          except asyncio.TimeoutError:
+            await self.sweep()
+            continue
+        else:
+          priority, _, book_id = self.queue.get_nowait()
+        if self.queued.get(book_id) != priority:
+          continue
+        del self.queued[book_id]
+
+        while (quiet := time.monotonic() - self.last_interaction) < self.quiet_period:
+          await asyncio.sleep(self.quiet_period - quiet)
+        await self.refresh(book_id)
+        if len(self.updates) >= self.batch_size:
+          await self.flush()
+      except Exception as error:
+        traceback.print_exception(error)
+
+  # Queues the books most in need of a check.
+  async def sweep(self):
+    now = time.time()
+    missing = or_(Book.thumbnail_url.is_(None), Book.goodreads_url.is_(None))
+    stmt = (
+        select(Book.id, missing)
+        .where(or_(
+            Book.refreshed_at.is_(None),
+            Book.refreshed_at < now - self.max_age,
+            and_(missing, Book.refreshed_at < now - self.min_age)))
+        .order_by(Book.refreshed_at.is_not(None), Book.refreshed_at)
+        .limit(self.sweep_size))
+    async with AsyncSession() as session:
+      for book_id, is_missing in await session.execute(stmt):
+        self.submit(book_id, self.MISSING if is_missing else self.STALE)
+
+  async def refresh(self, book_id: int):
+    async with AsyncSession() as session:
+      book = await session.get(Book, book_id)
+    now = time.time()
+    if not book or (book.refreshed_at and book.refreshed_at > now - self.min_age):
+      return
+
+    # The lookups for each field, in order of preference.
+    steps = {
+        "thumbnail_url": (
+            (self.cog.google_books_api, "thumbnail_from_isbn"),
+            (self.cog.open_library_api, "thumbnail_from_isbn")),
+        "goodreads_url": ((self.cog.goodreads_api, "link_from_isbn"),),
+    }
+    values = {"id": book.id, "refreshed_at": now}
+    for field, lookups in steps.items():
+      url = getattr(book, field)
+      if url and await self.resolves(url):
+        continue
+      new_url = None
+      for api, method in lookups if book.isbn else ():
+        # Don't get the broken link back from the cache.
+        await api.forget(method, book.isbn)
+        try:
+          new_url = await getattr(api, method)(book.isbn)
+        except Exception as error:
+          print(f"Unable to refresh {field} of book {book.id}: {error!r}")
+          continue
+        if new_url and await self.resolves(new_url):
+          break
+        new_url = None
+      if new_url != url:
+        values[field] = new_url
+        self.changed.add(book.id)
+    self.updates.append(values)
+
+  # Returns False if url is certainly broken. Errors give it the benefit of
+  # the doubt.
+  async def resolves(self, url: str) -> bool:
+    # Open Library serves a blank image for missing covers unless asked not to.
+    params = {"default": "false"} if "covers.openlibrary.org" in url else None
+    try:
+      r = await asyncio.to_thread(self.transport.head, url, params, "link_check", allow_redirects=True)
+    except Exception as error:
+      print(f"Unable to check {url}: {error!r}")
+      return True
+    return r.status_code not in (404, 410)
+
+  async def flush(self):
+    if not self.updates:
+      return
+    updates, self.updates = self.updates, []
+    changed, self.changed = self.changed, set()
+    async with AsyncSession() as session:
+      await session.execute(update(Book), updates)
+      await session.commit()
+    print(f"Refreshed {len(updates)} books, {len(changed)} changed.")
+
+    guild = self.cog.bot.get_guild(CONFIG.guild_id)
+    for book_id in changed:
+      render_cache.drop(book_id)
+      render = await load_render(book_id, guild)
+      channel = self.cog.bot.get_channel(self.cog.shelf_channel_id(render.shelf))
+      if render.message_id is None or not channel:
+        continue
+      try:
+        await channel.get_partial_message(render.message_id).edit(embed=render.embed())
+      except discord.HTTPException as error:
+        print(f"Unable to update the message of book {book_id}: {error!r}")
 
 
+# Candidates are only enriched once shown; paging also prefetches the next few
+# in the direction of travel.
 class BookChoice(ui.View):
-  def __init__(self, bot, books, original_message):
+  PREFETCH = 2
+  # Seconds submit() waits for the chosen book's enrichment. Discord expects a
+  # response to the click within 3 seconds.
+  SUBMIT_WAIT = 2
+
+  def __init__(self, bot, books, original_message, enrich):
     super().__init__(timeout=None)
     self.books = books
+    # Rendered embeds of enriched books by index, so paging back and forth is free.
+    self.embeds = {}
+    # Fills in a book's links and thumbnail.
+    self.enrich = enrich
+    # Enrichment tasks by book index.
+    self.enrichments = {}
     self.i = 0
     self.original_message = original_message
     self.view_message = None
     self.bot = bot
-
-  async def send_view(self, interaction: discord.Interaction, first=False):
-    match = "match" if len(self.books) == 1 else "matches"
-    args = {
-        "content": f"Showing match **{self.i+1}/{len(self.books)}**. Use the controls to finalize:",
-        "embed": embed_from_book(self.books[self.i], interaction.guild),
-        "view": self
-    }
-    if not self.view_message:
-      self.view_message = await interaction.followup.send(**args)
-      self.bot.add_view(self, message_id=self.view_message.id)
-    else:
-      await interaction.response.edit_message(**args)
+    # Whether more search results may still arrive.
+    self.searching = False
+    self.tasks = set()
+
+  def content(self) -> str:
+    content = f"Showing match **{self.i+1}/{len(self.books)}**. Use the controls to finalize:"
+    if self.searching:
+      content += " *(still searching...)*"
+    return content
+
+  def embed(self) -> discord.Embed:
+    if self.i in self.embeds:
+      return self.embeds[self.i]
+    embed = embed_from_book(self.books[self.i])
+    if self.enrichments[self.i].done():
+      self.embeds[self.i] = embed
+    return embed
+
+  def prefetch(self, i: int) -> asyncio.Task:
+    i %= len(self.books)
+    if i not in self.enrichments:
+      self.enrichments[i] = asyncio.create_task(self.enrich(self.books[i]))
+    return self.enrichments[i]
+
+  # Cancels the enrichments of all books but `keep`.
+  def cancel_prefetches(self, keep=None):
+    for i, task in self.enrichments.items():
+      if i != keep:
+        task.cancel()
+
+  async def send_view(self, interaction: discord.Interaction, first=False, direction=1):
+    enrichment = self.prefetch(self.i)
+    for step in range(1, self.PREFETCH + 1):
+      self.prefetch(self.i + direction * step)
+
+    await self.render_view(interaction)
+    # Don't hold up the response on enrichment; refresh the book once it's done.
+    if not enrichment.done():
+      task = asyncio.create_task(self.refresh_when_enriched(self.i, enrichment))
+      self.tasks.add(task)
+      task.add_done_callback(self.tasks.discard)
+
+  async def refresh_when_enriched(self, i: int, enrichment: asyncio.Task):
+    try:
+      await enrichment
+    except asyncio.CancelledError:
+      return
+    if self.i == i and not self.is_finished():
+      await self.view_message.edit(content=self.content(), embed=self.embed(), view=self)
+
+  async def render_view(self, interaction: discord.Interaction):
+    with profiling.span("render"):
+      args = {
+          "content": self.content(),
+          "embed": self.embed(),
+          "view": self
+      }
+    with profiling.span("send"):
+      if not self.view_message:
+        self.view_message = await interaction.followup.send(**args)
+        self.bot.add_view(self, message_id=self.view_message.id)
+      else:
+        await interaction.response.edit_message(**args)
+
+  # Appends newly found books and refreshes the message with the new count.
+  async def add_books(self, books, searching: bool):
+    self.books.extend(books)
+    # Later providers may have filled in fields of books already rendered.
+    self.embeds.clear()
+    changed = books or self.searching != searching
+    self.searching = searching
+    if changed and self.view_message and not self.is_finished():
+      await self.view_message.edit(content=self.content(), embed=self.embed(), view=self)
 
   async def disable_view(self, interaction: discord.Interaction, bye_message: str):
     # original_message = await self.original_itx.original_message()
     for button in self.children:
       button.disabled = True
-    await self.send_view(interaction)
+    self.cancel_prefetches()
+    await self.render_view(interaction)
     self.stop()
     await interaction.followup.send(content=bye_message, ephemeral=True)
     await self.original_message.delete(delay=DELAY)
 
 
   @ui.button(emoji=PREVIOUS_EMOJI, style=discord.ButtonStyle.secondary, custom_id="control_previous")
+  @metrics.timed("book_choice_previous")
   async def previous(self, interaction: discord.Interaction, button: ui.Button):
     self.i = (self.i - 1) % len(self.books)
-    await self.send_view(interaction)
+    await self.send_view(interaction, direction=-1)
 
   @ui.button(emoji=NEXT_EMOJI, style=discord.ButtonStyle.secondary, custom_id="control_next")
+  @metrics.timed("book_choice_next")
   async def next(self, interaction: discord.Interaction, button: ui.Button):
     self.i = (self.i + 1) % len(self.books)
     await self.send_view(interaction)
 
   @ui.button(label="Edit", emoji=EDIT_EMOJI, style=discord.ButtonStyle.secondary, custom_id="control_edit")
+  @metrics.timed("book_choice_edit")
   async def edit(self, interaction: discord.Interaction, button: ui.Button):
     modal = EditBookModal(self, self.books[self.i])
     await interaction.response.send_modal(modal)
@@ -249,20 +684,29 @@ class BookChoice(ui.View):
     result = await modal.await_submit()
     if result:
       itx, self.books[self.i] = result
+      self.embeds.pop(self.i, None)
       await self.send_view(itx)
     else:
       if not itx.response.done():
         await itx.response.send_message("Something went wrong editing your book.", ephemeral=True)
 
   @ui.button(label="Cancel", emoji=CANCEL_EMOJI, style=discord.ButtonStyle.secondary, custom_id="control_cancel")
+  @metrics.timed("book_choice_cancel")
   async def cancel(self, interaction: discord.Interaction, button: ui.Button):
     await self.disable_view(
         interaction,
         f"Your book submission has been canceled and will be removed in {DELAY} seconds.")
 
   @ui.button(label="Submit", emoji=SUBMIT_EMOJI, style=discord.ButtonStyle.secondary, custom_id="control_submit")
+  @metrics.timed("book_choice_submit")
   async def submit(self, interaction: discord.Interaction, button: ui.Button):
-    finalized_book = FinalizedBook(self.books[self.i])
+    # Stop first so that late search results don't overwrite the book.
+    self.stop()
+    self.cancel_prefetches(keep=self.i)
+    # Give the chosen book's links and thumbnail a moment to arrive, since the
+    # book is saved as it is.
+    await asyncio.wait({self.prefetch(self.i)}, timeout=self.SUBMIT_WAIT)
+    finalized_book = await FinalizedBook.create(self.books[self.i])
     await finalized_book.send_message(interaction)
 
   async def on_error(self, itx: discord.Interaction, error: Exception, item: ui.Item):
@@ -271,11 +715,23 @@ class BookChoice(ui.View):
 
 
 class BookoCog(commands.Cog):
-  def __init__(self, bot: commands.Bot, google_books_api, open_library_api, goodreads_api):
+  def __init__(
+      self, bot: commands.Bot, google_books_api, open_library_api, goodreads_api, max_concurrency=8, cache=None,
+      search_deadline=5.0, transport=None):
     self.bot = bot
-    self.google_books_api = google_books_api
-    self.open_library_api = open_library_api
-    self.goodreads_api = goodreads_api
+    self.cache = cache
+    # Stored links are only revalidated given a transport to check them with.
+    self.transport = transport
+    self.refresh_worker = None
+    # Whether on_ready has run.
+    self.ready = False
+    # Seconds to wait for each provider's search results.
+    self.search_deadline = search_deadline
+    # Each provider gets its own limit on in-flight requests, and its own
+    # threads, so that a throttled provider can't hold up the others.
+    self.google_books_api = AsyncApi(google_books_api, max_concurrency)
+    self.open_library_api = AsyncApi(open_library_api, max_concurrency)
+    self.goodreads_api = AsyncApi(goodreads_api, max_concurrency)
     self.channel_map = None
 
   def get_channel(self, channel_id: int):
@@ -286,6 +742,10 @@ class BookoCog(commands.Cog):
 
   @commands.Cog.listener()
   async def on_ready(self):
+    # on_ready fires again after every reconnect, but there's nothing to redo.
+    if self.ready:
+      print("Reconnected.")
+      return
     print("Initializing...")
 
     self.voting_channel = self.get_channel(CONFIG.voting_id)
@@ -311,49 +771,264 @@ class BookoCog(commands.Cog):
       await self.bot.close()
       return
 
-    await self.bot.tree.sync(guild=guild)
+    await self.sync_commands(guild)
 
-    with Session() as session:
-      for book in session.execute(select(Book)).scalars():
-        self.bot.add_view(FinalizedBook(book), message_id=book.message_id)
+    if self.transport and not self.refresh_worker:
+      self.refresh_worker = RefreshWorker(self, self.transport)
+      self.refresh_worker.start()
 
+    # Only now, so that an on_ready after a failed start tries again.
+    self.ready = True
     print(f"Running in {guild.name}!")
 
-  def get_books(self, author: str, title: str, shelf: Shelf, user_id: int):
-    books = self.google_books_api.search_author_title(author, title)
-    for book in books:
-      book.thumbnail_url = self.google_books_api.thumbnail_from_isbn(book.isbn)
-      if not book.thumbnail_url:
-        book.thumbnail_url = self.open_library_api.thumbnail_from_isbn(book.isbn)
-      book.open_library_url = self.open_library_api.link_from_isbn(book.isbn)
-      book.goodreads_url = self.goodreads_api.link_from_isbn(book.isbn)
-      book.shelf = shelf
-      book.user_id = user_id
+  # Syncs the guild's slash commands, unless they're unchanged since the last
+  # sync. Syncing is a slow, rate limited request.
+  async def sync_commands(self, guild: discord.Guild):
+    tree = self.bot.tree
+    payloads = sorted(
+        (command_payload(command, tree) for command in tree.get_commands(guild=guild)), key=lambda c: c["name"])
+    digest = hashlib.sha256(json.dumps(payloads, sort_keys=True).encode()).hexdigest()
+    key = f"command_tree_hash:{guild.id}"
+    async with AsyncSession() as session:
+      state = await session.get(models.BotState, key)
+      if state and state.value == digest:
+        print("Commands are unchanged; skipping sync.")
+        return
+      await self.bot.tree.sync(guild=guild)
+      await session.merge(models.BotState(key=key, value=digest))
+      await session.commit()
+    print("Synced commands.")
+
+  # These are only sent with the members intent, but keep the directory fresh
+  # when they are.
+  @commands.Cog.listener()
+  async def on_member_update(self, before: discord.Member, after: discord.Member):
+    member_directory.remember(after)
 
-    return books
+  @commands.Cog.listener()
+  async def on_user_update(self, before: discord.User, after: discord.User):
+    member_directory.remember(after)
+
+  # Routes every rating button click, past and present, to its book.
+  @commands.Cog.listener()
+  async def on_interaction(self, itx: discord.Interaction):
+    # Interactions carry the user, so use them to keep the directory fresh.
+    member_directory.remember(itx.user)
+    if self.refresh_worker:
+      self.refresh_worker.touch()
+    if itx.type != discord.InteractionType.component:
+      return
+    view, value = FinalizedBook.from_rating_custom_id(itx.data.get("custom_id", ""))
+    if not view:
+      return
+
+    self.viewed([view.book_id])
+    try:
+      await view.handle_rating(itx, value)
+    except Exception as error:
+      traceback.print_exception(error)
+      if not itx.response.is_done():
+        await itx.response.send_message(f"Error rating book: {str(error)}.", ephemeral=True)
+      else:
+        await itx.followup.send(f"Error rating book: {str(error)}.", ephemeral=True)
+
+  # Moves books the members are looking at to the front of the refresh queue.
+  def viewed(self, book_ids):
+    if self.refresh_worker:
+      for book_id in book_ids:
+        self.refresh_worker.submit(book_id, RefreshWorker.VIEWED)
+
+  # Fills in the field with the first of the (api, lookup) pairs to find it.
+  # Providers whose search returned the book are skipped, since they already
+  # said what they know about it.
+  async def enrich_field(self, book: Book, field: str, lookups):
+    if getattr(book, field):
+      # The search already filled it in.
+      metrics.enrichment_lookups.inc(field=field, outcome="avoided")
+      return
+    for api, lookup in lookups:
+      if api.api.name in getattr(book, "found_by", ()):
+        metrics.enrichment_lookups.inc(field=field, outcome="avoided")
+        continue
+      metrics.enrichment_lookups.inc(field=field, outcome="call")
+      try:
+        value = await lookup(book.isbn)
+      except Exception as error:
+        # Try the next lookup; the book can be shown without this field.
+        traceback.print_exception(error)
+        continue
+      if value:
+        setattr(book, field, value)
+        return
+
+  async def enrich_book(self, book: Book):
+    google, ol, goodreads = self.google_books_api, self.open_library_api, self.goodreads_api
+    # The lookups for each field, in order of preference.
+    steps = {
+        "thumbnail_url": ((google, google.thumbnail_from_isbn), (ol, ol.thumbnail_from_isbn)),
+        "open_library_url": ((ol, ol.link_from_isbn),),
+        "goodreads_url": ((goodreads, goodreads.link_from_isbn),),
+    }
+    with profiling.span("enrich", isbn=book.isbn):
+      await asyncio.gather(
+          *(self.enrich_field(book, field, lookups) for field, lookups in steps.items()))
+
+  # Yields (new books, whether more providers are pending) as each provider's
+  # search results arrive. Results are deduplicated by ISBN-13, and providers
+  # which fail or miss the deadline are skipped.
+  async def search_books(self, author: str, title: str, shelf: Shelf, user_id: int):
+    providers = (self.google_books_api, self.open_library_api)
+    tasks = [
+        asyncio.create_task(asyncio.wait_for(api.search_author_title(author, title), self.search_deadline))
+        for api in providers
+    ]
+    names = {task: api.api.name for task, api in zip(tasks, providers)}
+    pending = set(tasks)
+    # ISBN-13 -> the first book found with it.
+    seen = {}
+    try:
+      while pending:
+        # Spans can't stay open across the yield, so each wait gets its own.
+        with profiling.span("search", pending=len(pending)):
+          done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        books = []
+        # Keep the providers' order when several answer at once.
+        for task in (task for task in tasks if task in done):
+          try:
+            books += self.merge_books(task.result(), seen, names[task])
+          except Exception as error:
+            print(f"Search on {names[task]} failed: {error!r}")
+        for book in books:
+          book.shelf = shelf
+          book.user_id = user_id
+        if books:
+          yield books, bool(pending)
+    finally:
+      for task in pending:
+        task.cancel()
+
+    if self.cache:
+      print(f"API cache: {self.cache.stats()}")
+
+  # Returns the books whose ISBN hasn't been seen yet. Duplicates fill in any
+  # fields the first book found was missing. Each book's found_by records the
+  # providers whose search returned it.
+  def merge_books(self, books, seen, provider: str):
+    new = []
+    for book in books:
+      key = to_isbn13(book.isbn)
+      if key not in seen:
+        book.found_by = {provider}
+        seen[key] = book
+        new.append(book)
+        continue
+      seen[key].found_by.add(provider)
+      for field in Book.METADATA_FIELDS:
+        if not getattr(seen[key], field):
+          setattr(seen[key], field, getattr(book, field))
+    return new
 
   @app_commands.command(description="Adds a new book.")
   @app_commands.guilds(CONFIG.guild_id)
   @app_commands.describe(suggester="the user who suggested the book (defaults to you)")
   async def add_book(self, itx: discord.Interaction, title: str, author: str, suggester: discord.User = None):
+    with profiling.span("add_book"):
+      await self.add_book_impl(itx, title, author, suggester)
+
+  async def add_book_impl(self, itx: discord.Interaction, title: str, author: str, suggester: discord.User):
     if itx.channel.id not in self.channel_map:
       raise app_commands.AppCommandError("Invalid channel for this command!")
 
     # Default to the user
     if not suggester:
       suggester = itx.user
+    member_directory.remember(suggester)
 
-    await itx.response.defer(thinking=True)
+    with profiling.span("defer"):
+      await itx.response.defer(thinking=True)
     shelf = self.channel_map[itx.channel.id]
-    books = self.get_books(author, title, shelf, suggester.id)
-    if not books:
+
+    # Check the library first; there's no need to search for a book it has.
+    with profiling.span("lookup"):
+      exact, similar = await self.find_existing(title, author, shelf)
+    if exact:
+      await itx.followup.send(
+          "That book is already here:\n" + "\n".join(self.describe_match(*row) for row in exact),
+          wait=True)
+      return
+
+    # Show the first results right away and add the rest as they arrive.
+    view = None
+    async with contextlib.aclosing(self.search_books(author, title, shelf, suggester.id)) as results:
+      async for books, searching in results:
+        if not view:
+          original_message = await itx.original_message()
+          view = BookChoice(self.bot, books, original_message, self.enrich_book)
+          view.searching = searching
+          await view.send_view(itx, first=True)
+        elif view.is_finished():
+          # Submitted or canceled; the remaining results aren't needed.
+          break
+        else:
+          await view.add_books(books, searching)
+    if not view:
       await itx.followup.send(
           f"Unable to find any books matching: *{title}* by {author}.", ephemeral=True, wait=True)
       return
+    await view.add_books([], searching=False)
+    if similar:
+      await itx.followup.send(
+          "Similar books already in the library:\n" + "\n".join(self.describe_match(*row) for row in similar),
+          ephemeral=True)
+
+  # Returns the (book, rating count, average rating) rows on shelf which exactly
+  # match the title (or ISBN) and author, and the other close matches.
+  async def find_existing(self, title: str, author: str, shelf: Shelf):
+    isbn = title.replace("-", "").strip().upper()
+    async with AsyncSession() as session:
+      if ISBN.fullmatch(isbn):
+        stmt = models.books_with_ratings().where(Book.isbn.in_({isbn, to_isbn13(isbn)}))
+        rows = (await session.execute(stmt)).all()
+        is_exact = lambda book: True
+      else:
+        rows = (await session.execute(models.search_books(f"{title} {author}"))).all()
+        is_exact = lambda book: (
+            normalize(book.title) == normalize(title) and normalize(book.author) == normalize(author))
+
+    self.viewed(row[0].id for row in rows)
+    exact = [row for row in rows if row[0].shelf == shelf and is_exact(row[0])]
+    similar = [row for row in rows if row not in exact]
+    return exact, similar
+
+  def describe_match(self, book: Book, count: int, average: float) -> str:
+    rating = f"{STAR_EMOJI} {average:.1f} from {count}" if count else "unrated"
+    description = f"*{book.title}* by {book.author} ({rating})"
+    channel_id = self.shelf_channel_id(book.shelf)
+    if book.message_id and channel_id:
+      description += f" https://discord.com/channels/{CONFIG.guild_id}/{channel_id}/{book.message_id}"
+    return description
+
+  def shelf_channel_id(self, shelf: Shelf) -> int:
+    return next((channel_id for channel_id, channel_shelf in self.channel_map.items() if channel_shelf == shelf), None)
+
+  @app_commands.command(description="Searches the library by title and author.")
+  @app_commands.guilds(CONFIG.guild_id)
+  @app_commands.describe(query="words from the title or author")
+  async def search(self, itx: discord.Interaction, query: str):
+    if not query.split():
+      raise app_commands.AppCommandError("Give me something to search for!")
+    async with AsyncSession() as session:
+      rows = (await session.execute(models.search_books(query))).all()
+    if not rows:
+      await itx.response.send_message(f"No books matching: {query}.", ephemeral=True)
+      return
+    self.viewed(row[0].id for row in rows)
+    await itx.response.send_message(
+        "\n".join(self.describe_match(*row) for row in rows)[:2000], ephemeral=True)
 
-    original_message = await itx.original_message()
-    view = BookChoice(self.bot, books, original_message)
-    await view.send_view(itx, first=True)
+  @search.error
+  async def on_search_error(self, itx: discord.Interaction, error: app_commands.AppCommandError):
+    await self.on_add_book_error(itx, error)
 
   @add_book.error
   async def on_add_book_error(self, itx: discord.Interaction, error: app_commands.AppCommandError):
@@ -363,6 +1038,104 @@ class BookoCog(commands.Cog):
     else:
       await itx.followup.send(str(error), ephemeral=True)
 
+  @app_commands.command(description="Shows the top rated books and the most active raters.")
+  @app_commands.guilds(CONFIG.guild_id)
+  @app_commands.describe(count="how many books and raters to show")
+  async def leaderboard(self, itx: discord.Interaction, count: app_commands.Range[int, 1, 25] = 10):
+    async with AsyncSession() as session:
+      books = (await session.execute(models.top_books(count))).all()
+      raters = (await session.execute(models.top_raters(count))).scalars().all()
+    if not books:
+      await itx.response.send_message("Nothing has been rated yet.", ephemeral=True)
+      return
+
+    lines = ["**Top rated**"]
+    for i, (book, stats) in enumerate(books, 1):
+      lines.append(f"{i}. {self.describe_match(book, stats.count, stats.score)}")
+    lines.append("**Most ratings**")
+    for i, stats in enumerate(raters, 1):
+      lines.append(f"{i}. <@{stats.user_id}>: {stats.count} ratings, {stats.total / stats.count:.1f} on average")
+    await itx.response.send_message(
+        "\n".join(lines)[:2000], ephemeral=True, allowed_mentions=discord.AllowedMentions.none())
+
+  @leaderboard.error
+  async def on_leaderboard_error(self, itx: discord.Interaction, error: app_commands.AppCommandError):
+    await self.on_add_book_error(itx, error)
+
+  @app_commands.command(description="Shows the ratings of the best match for a title or author.")
+  @app_commands.guilds(CONFIG.guild_id)
+  @app_commands.describe(query="words from the title or author")
+  async def book_stats(self, itx: discord.Interaction, query: str):
+    if not query.split():
+      raise app_commands.AppCommandError("Give me something to search for!")
+    async with AsyncSession() as session:
+      row = (await session.execute(models.search_books(query, limit=1))).first()
+      stats = row and await session.get(models.BookRatingStats, row[0].id)
+    if not row:
+      await itx.response.send_message(f"No books matching: {query}.", ephemeral=True)
+      return
+
+    book = row[0]
+    lines = [f"*{book.title}* by {book.author}"]
+    if not stats or not stats.count:
+      lines.append("No ratings yet.")
+    else:
+      lines.append(f"{STAR_EMOJI} {stats.score:.2f} from {stats.count} ratings")
+      histogram = stats.histogram()
+      for value in range(5, 0, -1):
+        n = histogram[value - 1]
+        bar = "\u2588" * round(10 * n / stats.count)
+        lines.append(f"`{value}` {bar} {n}")
+    await itx.response.send_message("\n".join(lines), ephemeral=True)
+
+  @book_stats.error
+  async def on_book_stats_error(self, itx: discord.Interaction, error: app_commands.AppCommandError):
+    await self.on_add_book_error(itx, error)
+
+  @app_commands.command(description="Recomputes the rating aggregates from every rating.")
+  @app_commands.guilds(CONFIG.guild_id)
+  @app_commands.checks.has_permissions(administrator=True)
+  async def rebuild_rating_stats(self, itx: discord.Interaction):
+    await itx.response.defer(ephemeral=True, thinking=True)
+    async with AsyncSession() as session:
+      await session.run_sync(lambda session: models.rebuild_rating_stats(session.connection()))
+      await session.commit()
+    await itx.followup.send("Rebuilt the rating aggregates.", ephemeral=True)
+
+  @rebuild_rating_stats.error
+  async def on_rebuild_rating_stats_error(self, itx: discord.Interaction, error: app_commands.AppCommandError):
+    await self.on_add_book_error(itx, error)
+
+  @app_commands.command(description="Shows API, database and interaction stats.")
+  @app_commands.guilds(CONFIG.guild_id)
+  @app_commands.checks.has_permissions(administrator=True)
+  async def booko_stats(self, itx: discord.Interaction):
+    sections = {
+        "API requests": metrics.api_requests,
+        "Database transactions": metrics.db_transactions,
+        "Interactions": metrics.interactions,
+    }
+    lines = []
+    for name, histogram in sections.items():
+      lines.append(f"**{name}**")
+      for labels, (count, mean) in sorted(histogram.summary().items()):
+        lines.append(f"`{' '.join(labels)}`: {count} in {mean * 1000:.1f}ms on average")
+    lookups = metrics.enrichment_lookups.samples()
+    if lookups:
+      lines.append("**Enrichment lookups**")
+      lines.append(", ".join(f"{field} {outcome}: {count}" for _, (field, outcome), _, count in sorted(lookups)))
+    states = {0: "closed", 1: "half open", 2: "open"}
+    breakers = metrics.api_circuit_state.samples()
+    if breakers:
+      lines.append("**Circuit breakers**")
+      lines.append(", ".join(f"{provider}: {states[state]}" for _, (provider,), _, state in sorted(breakers)))
+    # Messages are limited to 2000 characters.
+    await itx.response.send_message("\n".join(lines)[:2000], ephemeral=True)
+
+  @booko_stats.error
+  async def on_booko_stats_error(self, itx: discord.Interaction, error: app_commands.AppCommandError):
+    await self.on_add_book_error(itx, error)
+
 
 async def main():
   parser = argparse.ArgumentParser()
@@ -371,16 +1144,42 @@ async def main():
   parser.add_argument(
       "--google_books_key", default="data/books_api", help="The Google Books API key.")
   parser.add_argument(
-      "--database", default="data/test_alchemy.db", help="The Sqlite3 database to use.")
+      "--database", default="data/test_alchemy.db", help="The SQLite database, or a database URL.")
+  parser.add_argument(
+      "--db_pool_size", type=int, default=5, help="Database connections to keep open.")
+  parser.add_argument(
+      "--db_max_overflow", type=int, default=10, help="Extra database connections to open under load.")
   parser.add_argument(
       "--verbose_api", action="store_true", help="Whether or not to verbosely log API calls.")
   parser.add_argument(
       "--verbose_db", action="store_true", help="Whether or not to verbosely log the database.")
+  parser.add_argument(
+      "--max_concurrency", type=int, default=8, help="The maximum number of concurrent requests to each API.")
+  parser.add_argument(
+      "--search_deadline", type=float, default=5.0, help="Seconds to wait for each provider's search results.")
+  parser.add_argument(
+      "--metrics_port", type=int, help="Serve Prometheus metrics on this localhost port.")
+  parser.add_argument(
+      "--profile", action="store_true", help="Trace interactions and event loop stalls.")
+  parser.add_argument(
+      "--profile_trace", default="data/trace.jsonl", help="The JSONL file to write --profile traces to.")
+  parser.add_argument(
+      "--stall_threshold", type=float, default=0.1, help="Seconds the event loop may be held before it's a stall.")
+  parser.add_argument(
+      "--rating_window", type=float, default=1.0, help="Seconds to batch rating clicks for.")
+  parser.add_argument(
+      "--edit_interval", type=float, default=1.0, help="Minimum seconds between message edits in a channel.")
   args = parser.parse_args()
 
-  global Session
-  models.initialize(args.database)
-  Session = models.Session
+  global AsyncSession, rating_coalescer
+  models.initialize(args.database, args.db_pool_size, args.db_max_overflow)
+  AsyncSession = models.AsyncSession
+  rating_coalescer = RatingCoalescer(args.rating_window, args.edit_interval)
+
+  if args.metrics_port:
+    metrics.serve(args.metrics_port)
+  if args.profile:
+    profiling.enable(args.profile_trace, args.stall_threshold)
 
   with open(args.discord_token, "r") as token_file:
     discord_token = token_file.read().strip()
@@ -388,16 +1187,22 @@ async def main():
   with open(args.google_books_key, "r") as key_file:
     google_books_key = key_file.read().strip()
 
+  # Members are resolved lazily by member_directory, so the privileged members
+  # intent isn't needed.
   intents = discord.Intents.default()
-  intents.members = True
   bot = commands.Bot("!", intents=intents)
 
-  google_books_api = GoogleBooksApi(google_books_key, args.verbose_api)
-  open_library_api = OpenLibraryApi(args.verbose_api)
-  goodreads_api = GoodreadsApi(args.verbose_api)
+  cache = BookCache()
+  transport = Transport()
+  google_books_api = CachedApi(
+      GoogleBooksApi(google_books_key, args.verbose_api, transport=transport), cache)
+  open_library_api = CachedApi(OpenLibraryApi(args.verbose_api, transport=transport), cache)
+  goodreads_api = CachedApi(GoodreadsApi(args.verbose_api, transport), cache)
 
   async with bot:
-    await bot.add_cog(BookoCog(bot, google_books_api, open_library_api, goodreads_api))
+    await bot.add_cog(BookoCog(
+        bot, google_books_api, open_library_api, goodreads_api, args.max_concurrency, cache,
+        args.search_deadline, transport))
     await bot.start(discord_token)
 
 
@@ -0,0 +1,88 @@
+import models
+import os
+import sqlite3
+import sys
+import tempfile
+
+
+from models import Book, BookRatingStats
+from sqlalchemy import func, select
+
+
+# The schema every existing install was created with, before any migrations.
+BASELINE_SCHEMA = """
+CREATE TABLE books (
+  id INTEGER NOT NULL,
+  title VARCHAR,
+  author VARCHAR,
+  isbn VARCHAR,
+  open_library_url VARCHAR,
+  goodreads_url VARCHAR,
+  thumbnail_url VARCHAR,
+  shelf VARCHAR(11),
+  message_id INTEGER,
+  user_id INTEGER,
+  PRIMARY KEY (id)
+);
+CREATE TABLE ratings (
+  id INTEGER NOT NULL,
+  user_id INTEGER,
+  book_id INTEGER,
+  rating INTEGER,
+  PRIMARY KEY (id),
+  FOREIGN KEY(book_id) REFERENCES books (id)
+);
+"""
+
+
+# Builds a baseline database, including the duplicate ratings the baseline
+# allowed, and migrates it with models.initialize().
+def check(path):
+  connection = sqlite3.connect(path)
+  connection.executescript(BASELINE_SCHEMA)
+  connection.executemany(
+      "INSERT INTO books (id, title, author, isbn, shelf, message_id, user_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+      [(1, "The Hobbit", "J. R. R. Tolkien", "9780547928227", "READ", 100, 1),
+       (2, "Dune", "Frank Herbert", "9780441172719", "RECOMMENDED", 200, 2)])
+  connection.executemany(
+      "INSERT INTO ratings (user_id, book_id, rating) VALUES (?, ?, ?)",
+      [(1, 1, 3), (1, 1, 5), (2, 1, 4), (2, 2, 2)])
+  connection.commit()
+  connection.close()
+
+  models.initialize(path)
+
+  latest = models.MIGRATIONS[-1][0]
+  with models.Session() as session:
+    connection = session.connection()
+    version = models.schema_version(connection)
+    assert version == latest, f"Schema version is {version}, not {latest}."
+
+    indexes = {row[0] for row in connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    expected = {index.name for table in models.Base.metadata.sorted_tables for index in table.indexes}
+    assert expected <= indexes, f"Missing indexes: {sorted(expected - indexes)}."
+
+    ratings = session.execute(select(func.count()).select_from(models.Rating)).scalar()
+    assert ratings == 3, f"Expected the duplicate rating to be dropped, found {ratings} ratings."
+    stats = session.get(BookRatingStats, 1)
+    assert (stats.count, stats.total) == (2, 9), f"Wrong rating stats: {stats}."
+
+    plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN SELECT * FROM ratings WHERE book_id IN (1)").all()
+    assert "SCAN ratings" not in str(plan), f"Loading a book's ratings scans the table: {plan}."
+
+    books = session.execute(models.search_books("hobbit")).scalars().all()
+    assert [book.id for book in books] == [1], f"Search found {books}."
+    assert session.get(Book, 1).refreshed_at is None
+
+
+def main():
+  with tempfile.TemporaryDirectory() as tmp:
+    try:
+      check(os.path.join(tmp, "baseline.db"))
+    except AssertionError as e:
+      sys.exit(f"Migration check failed: {e}")
+  print("Migrated a baseline database to the latest schema.")
+
+
+if __name__ == "__main__":
+  main()
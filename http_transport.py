@@ -0,0 +1,228 @@
+import collections
+import metrics
+import random
+import requests
+import threading
+import time
+
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+
+# Statuses worth retrying: rate limiting and transient server errors.
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# provider -> (requests per second, burst). Goodreads' search redirect is
+# scraped rather than an API, so it's kept especially slow.
+RATE_LIMITS = {
+    "google_books": (5, 10),
+    "open_library": (5, 10),
+    "goodreads": (1, 3),
+    # Background checks that stored links still resolve.
+    "link_check": (1, 2),
+}
+
+
+# Raised instead of making a request while a provider's breaker is open.
+class CircuitOpenError(requests.RequestException):
+  pass
+
+
+# Hands out up to `rate` tokens a second, saving up at most `burst` of them.
+class TokenBucket:
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  # Takes a token, first sleeping until one is available. Returns the wait.
+  def acquire(self) -> float:
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      # Claim the token now, even if it's borrowed, so waiters queue in order.
+      self.tokens -= 1
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+    if wait:
+      time.sleep(wait)
+    return wait
+
+
+# Stops requests to a provider after `threshold` failures in a row. After
+# `cool_off` seconds one request is let through to probe it: success closes the
+# breaker again and failure reopens it.
+class CircuitBreaker:
+  CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+  def __init__(self, provider, threshold=5, cool_off=30):
+    self.provider = provider
+    self.threshold = threshold
+    self.cool_off = cool_off
+    self.failures = 0
+    self.opened_at = None
+    self.probing = False
+    self.lock = threading.Lock()
+    metrics.api_circuit_state.set(self.CLOSED, provider=provider)
+
+  def state(self):
+    if self.opened_at is None:
+      return self.CLOSED
+    if time.monotonic() - self.opened_at < self.cool_off:
+      return self.OPEN
+    return self.HALF_OPEN
+
+  # Returns whether a request may be made now.
+  def allow(self) -> bool:
+    with self.lock:
+      state = self.state()
+      metrics.api_circuit_state.set(state, provider=self.provider)
+      if state == self.CLOSED:
+        return True
+      if state == self.HALF_OPEN and not self.probing:
+        self.probing = True
+        return True
+    metrics.api_short_circuits.inc(provider=self.provider)
+    return False
+
+  def record(self, success: bool):
+    with self.lock:
+      self.probing = False
+      if success:
+        self.failures = 0
+        self.opened_at = None
+      else:
+        self.failures += 1
+        if self.failures >= self.threshold or self.opened_at is not None:
+          if self.opened_at is None:
+            print(f"Too many {self.provider} errors; pausing requests for {self.cool_off}s.")
+          self.opened_at = time.monotonic()
+      metrics.api_circuit_state.set(self.state(), provider=self.provider)
+
+
+class LatencyStats:
+  def __init__(self):
+    self.requests = 0
+    self.errors = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def record(self, seconds, error=False):
+    self.requests += 1
+    self.errors += error
+    self.total += seconds
+    self.max = max(self.max, seconds)
+
+  def as_dict(self):
+    mean = self.total / self.requests if self.requests else 0.0
+    return {"requests": self.requests, "errors": self.errors, "mean": mean, "max": self.max}
+
+
+# A shared HTTP client for the book APIs. It keeps a pool of keep-alive
+# connections per host, bounds every request with connect/read timeouts and
+# retries rate limited or failed requests with jittered exponential backoff.
+# Requests are also rate limited per provider, and a circuit breaker per
+# provider stops requests to it while it's failing.
+class Transport:
+  def __init__(
+      self,
+      connect_timeout=3.05,
+      read_timeout=10,
+      retries=2,
+      backoff=0.5,
+      max_backoff=8,
+      pool_hosts=8,
+      pool_size=16,
+      rate_limits=RATE_LIMITS,
+      breaker_threshold=5,
+      breaker_cool_off=30):
+    self.timeout = (connect_timeout, read_timeout)
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+    self.session.mount("https://", adapter)
+    self.session.mount("http://", adapter)
+
+    self.lock = threading.Lock()
+    self.latency = collections.defaultdict(LatencyStats)
+
+    self.buckets = {provider: TokenBucket(*limit) for provider, limit in rate_limits.items()}
+    self.breakers = {
+        provider: CircuitBreaker(provider, breaker_threshold, breaker_cool_off)
+        for provider in rate_limits
+    }
+
+  def get(self, url, params=None, provider=None, **kwargs) -> requests.Response:
+    return self.request("GET", url, params, provider, **kwargs)
+
+  def head(self, url, params=None, provider=None, **kwargs) -> requests.Response:
+    return self.request("HEAD", url, params, provider, **kwargs)
+
+  # provider labels the request in metrics, defaulting to the host, and picks
+  # its rate limit and circuit breaker. Raises requests.HTTPError if the
+  # provider is still rate limiting or failing after every retry.
+  def request(self, method, url, params=None, provider=None, **kwargs) -> requests.Response:
+    parts = urlsplit(url)
+    host = parts.netloc
+    labels = {"provider": provider or host, "endpoint": parts.path}
+    bucket = self.buckets.get(provider)
+    breaker = self.breakers.get(provider)
+    for attempt in range(self.retries + 1):
+      if breaker and not breaker.allow():
+        raise CircuitOpenError(f"Requests to {provider} are paused after repeated errors.")
+      if attempt:
+        metrics.api_retries.inc(**labels)
+      if bucket:
+        metrics.api_throttle.observe(bucket.acquire(), provider=provider)
+      start = time.perf_counter()
+      try:
+        r = self.session.request(method, url, params=params, timeout=self.timeout, **kwargs)
+      except (requests.ConnectionError, requests.Timeout):
+        self._record(host, time.perf_counter() - start, "error", labels)
+        if breaker:
+          breaker.record(success=False)
+        if attempt == self.retries:
+          raise
+        time.sleep(self._delay(attempt))
+        continue
+      except Exception:
+        # Anything else (e.g. an invalid URL) also counts as a failure, and
+        # must end the breaker's probe so the provider isn't paused for good.
+        self._record(host, time.perf_counter() - start, "error", labels)
+        if breaker:
+          breaker.record(success=False)
+        raise
+
+      self._record(host, time.perf_counter() - start, r.status_code, labels)
+      failed = r.status_code in RETRY_STATUSES
+      if breaker:
+        breaker.record(success=not failed)
+      if failed and attempt < self.retries:
+        time.sleep(self._delay(attempt, r.headers.get("Retry-After")))
+        continue
+      if failed:
+        r.raise_for_status()
+      return r
+
+  def stats(self):
+    with self.lock:
+      return {host: stats.as_dict() for host, stats in self.latency.items()}
+
+  def _record(self, host, seconds, status, labels):
+    metrics.api_requests.observe(seconds, status=status, **labels)
+    error = status == "error" or status >= 400
+    with self.lock:
+      self.latency[host].record(seconds, error)
+
+  def _delay(self, attempt, retry_after=None):
+    # Honor the server's Retry-After when it gives one in seconds.
+    if retry_after and retry_after.isdigit():
+      return min(float(retry_after), self.max_backoff)
+    # "Full jitter": a random delay up to the exponential backoff.
+    return random.uniform(0, min(self.backoff * 2**attempt, self.max_backoff))
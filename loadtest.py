@@ -0,0 +1,144 @@
+import argparse
+import collections
+import models
+import os
+import random
+import tempfile
+import threading
+import time
+
+
+from metrics import percentile
+from models import Book, Rating, Shelf
+from sqlalchemy import func, insert, select
+
+
+def fake_isbn(i):
+  return f"978{i:010d}"
+
+
+def report(name, latencies, errors, elapsed):
+  latencies.sort()
+  print(
+      f"  {name:<10} n={len(latencies):<7} "
+      f"p50={percentile(latencies, .5) * 1000:8.2f}ms "
+      f"p95={percentile(latencies, .95) * 1000:8.2f}ms "
+      f"p99={percentile(latencies, .99) * 1000:8.2f}ms "
+      f"{len(latencies) / elapsed:9.1f} ops/s")
+  for error, count in errors.most_common():
+    print(f"    {count} x {error}")
+
+
+# Fills an empty database with `size` books, each with a few ratings.
+def fill(size):
+  with models.Session() as session:
+    if session.execute(select(func.count()).select_from(Book)).scalar():
+      return
+    session.execute(insert(Book), [{
+        "title": f"Book {i}",
+        "author": f"Author {i % 1000}",
+        "isbn": fake_isbn(i),
+        "shelf": Shelf.READ,
+        "message_id": i,
+        "user_id": i % 100,
+    } for i in range(1, size + 1)])
+    session.execute(insert(Rating), [
+        {"user_id": user_id, "book_id": i, "rating": random.randint(1, 5)}
+        for i in range(1, size + 1) for user_id in random.sample(range(1000), 3)])
+    models.rebuild_rating_stats(session.connection())
+    session.commit()
+
+
+# A rating click, as FinalizedBook.apply_ratings writes it.
+def rate(session, size):
+  user_id, book_id = random.randrange(1000), random.randint(1, size)
+  old = session.execute(models.select_rating(user_id, book_id)).scalar()
+  upsert, cleanup = models.toggle_rating(user_id, book_id, random.randint(1, 5))
+  new = session.execute(upsert).scalar()
+  session.execute(cleanup)
+  for stmt, params in models.rating_stats_updates([(book_id, user_id, old, new)]):
+    session.execute(stmt, params)
+  session.commit()
+
+
+# A batch of books, as book_import writes them.
+def import_batch(session, size, batch_size=200):
+  session.execute(insert(Book), [{
+      "title": f"Imported {random.randrange(size)}",
+      "author": "Importer",
+      "isbn": fake_isbn(random.randrange(size)),
+      "shelf": Shelf.RECOMMENDED,
+  } for _ in range(batch_size)])
+  session.commit()
+
+
+# The bot's read paths: leaderboards, searches and book lookups.
+def read(session, size):
+  match random.randrange(3):
+    case 0:
+      session.execute(models.top_books(10)).all()
+    case 1:
+      session.execute(models.search_books(f"Author {random.randrange(1000)}")).all()
+    case 2:
+      session.execute(models.books_with_ratings().where(Book.id == random.randint(1, size))).all()
+
+
+def worker(operation, size, deadline, latencies, errors):
+  while time.perf_counter() < deadline:
+    start = time.perf_counter()
+    with models.Session() as session:
+      try:
+        operation(session, size)
+      except Exception as e:
+        errors[f"{type(e).__name__}: {str(e).splitlines()[0]}"] += 1
+        continue
+    latencies.append(time.perf_counter() - start)
+
+
+def run(name, database, args, pragmas):
+  print(f"{name}:")
+  roles = {"read": (read, args.readers), "rate": (rate, args.writers), "import": (import_batch, args.importers)}
+  models.initialize(database, pool_size=sum(count for _, count in roles.values()), pragmas=pragmas)
+  fill(args.books)
+
+  deadline = time.perf_counter() + args.seconds
+  results = {role: ([], collections.Counter()) for role in roles}
+  threads = [
+      threading.Thread(target=worker, args=(operation, args.books, deadline, *results[role]))
+      for role, (operation, count) in roles.items() for _ in range(count)
+  ]
+  start = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - start
+  for role, (latencies, errors) in results.items():
+    report(role, latencies, errors, elapsed)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Runs concurrent readers and writers against each database. With no databases, "
+      "compares SQLite with and without the tuned pragmas.")
+  parser.add_argument("databases", nargs="*", help="Database URLs or SQLite paths. Empty databases are filled first.")
+  parser.add_argument("--readers", type=int, default=8)
+  parser.add_argument("--writers", type=int, default=4, help="Threads toggling ratings.")
+  parser.add_argument("--importers", type=int, default=1, help="Threads inserting batches of books.")
+  parser.add_argument("--seconds", type=float, default=10)
+  parser.add_argument("--books", type=int, default=10_000)
+  args = parser.parse_args()
+
+  if args.databases:
+    for database in args.databases:
+      run(database, database, args, models.SQLITE_PRAGMAS)
+    return
+
+  # WAL mode sticks to the file, so each profile gets its own database.
+  with tempfile.TemporaryDirectory() as tmp:
+    run("SQLite, default settings", os.path.join(tmp, "default.db"), args, {})
+    run("SQLite, tuned", os.path.join(tmp, "tuned.db"), args, models.SQLITE_PRAGMAS)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import discord
+import models
+import time
+
+
+from models import User
+from sqlalchemy import select
+
+
+DAY = 24 * 60 * 60
+
+
+# Resolves user ids to their names and avatars without the members intent.
+# Users are kept in an in-memory LRU in front of the `users` table. Misses are
+# fetched from Discord in batches, and users are refreshed whenever they're
+# seen in an interaction or a member update.
+class MemberDirectory:
+  # query_members() takes at most 100 user ids.
+  MAX_QUERY = 100
+
+  def __init__(self, memory_size=4096, max_age=7*DAY, batch_window=0.01, write_window=1.0):
+    self.memory_size = memory_size
+    self.max_age = max_age
+    self.batch_window = batch_window
+    self.write_window = write_window
+    # user id -> User, in least to most recently used order.
+    self.memory = collections.OrderedDict()
+    # user id -> future of a pending fetch from Discord.
+    self.wanted = {}
+    # user id -> User waiting to be written to the database.
+    self.dirty = {}
+    self.tasks = set()
+
+  # Returns the user if it's in memory. Call resolve() first to load it.
+  def get(self, user_id: int) -> User:
+    user = self.memory.get(user_id)
+    if user:
+      self.memory.move_to_end(user_id)
+    return user
+
+  # Records a user seen in an interaction or event.
+  def remember(self, member: discord.abc.User):
+    user = User(
+        id=member.id,
+        name=member.name,
+        discriminator=member.discriminator,
+        avatar_url=member.display_avatar.url,
+        updated_at=time.time())
+    old = self.memory.get(member.id)
+    self._remember(user)
+    fresh = old and old.updated_at > user.updated_at - self.max_age
+    if fresh and (old.name, old.discriminator, old.avatar_url) == (user.name, user.discriminator, user.avatar_url):
+      return
+    if not self.dirty:
+      self._spawn(self.write())
+    self.dirty[user.id] = user
+
+  # Loads the given users into memory, from the database or else Discord.
+  async def resolve(self, guild: discord.Guild, user_ids):
+    missing = {user_id for user_id in user_ids if user_id and user_id not in self.memory}
+    if not missing:
+      return
+
+    now = time.time()
+    async with models.AsyncSession() as session:
+      users = (await session.execute(select(User).where(User.id.in_(missing)))).scalars().all()
+    for user in users:
+      self._remember(user)
+      # Stale users are still shown, but are fetched again.
+      if user.updated_at > now - self.max_age:
+        missing.discard(user.id)
+    if missing:
+      await self.fetch(guild, missing)
+
+  # Fetches users from Discord. Concurrent fetches within batch_window of each
+  # other share a request.
+  async def fetch(self, guild: discord.Guild, user_ids):
+    loop = asyncio.get_running_loop()
+    if not self.wanted:
+      self._spawn(self.query(guild))
+    futures = [self.wanted.setdefault(user_id, loop.create_future()) for user_id in user_ids]
+    await asyncio.gather(*futures)
+
+  async def query(self, guild: discord.Guild):
+    await asyncio.sleep(self.batch_window)
+    wanted, self.wanted = self.wanted, {}
+    user_ids = list(wanted)
+    try:
+      for i in range(0, len(user_ids), self.MAX_QUERY):
+        for member in await guild.query_members(user_ids=user_ids[i:i + self.MAX_QUERY], cache=False):
+          self.remember(member)
+    except Exception as error:
+      print(f"Unable to fetch members {user_ids}: {error!r}")
+    # Users who weren't found (e.g. they left) are rendered without details.
+    for future in wanted.values():
+      future.set_result(None)
+
+  async def write(self):
+    await asyncio.sleep(self.write_window)
+    dirty, self.dirty = self.dirty, {}
+    upsert = models.dialect_insert(User)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[User.id],
+        set_={column: upsert.excluded[column] for column in ("name", "discriminator", "avatar_url", "updated_at")})
+    async with models.AsyncSession() as session:
+      await session.execute(upsert, [
+          {column: getattr(user, column) for column in ("id", "name", "discriminator", "avatar_url", "updated_at")}
+          for user in dirty.values()
+      ])
+      await session.commit()
+
+  def _remember(self, user: User):
+    self.memory[user.id] = user
+    self.memory.move_to_end(user.id)
+    while len(self.memory) > self.memory_size:
+      self.memory.popitem(last=False)
+
+  def _spawn(self, coroutine):
+    task = asyncio.create_task(coroutine)
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
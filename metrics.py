@@ -0,0 +1,205 @@
+import functools
+import threading
+import time
+
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Latency histogram bucket upper bounds, in seconds.
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def percentile(sorted_values, q):
+  if not sorted_values:
+    return 0.0
+  return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def format_labels(label_names, label_values, extra=()):
+  pairs = list(zip(label_names, label_values)) + list(extra)
+  if not pairs:
+    return ""
+  return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Counter:
+  kind = "counter"
+
+  def __init__(self, name, help, label_names=()):
+    self.name = name
+    self.help = help
+    self.label_names = label_names
+    self.lock = threading.Lock()
+    # label values -> count
+    self.values = {}
+
+  def inc(self, amount=1, **labels):
+    key = tuple(str(labels[name]) for name in self.label_names)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def samples(self):
+    with self.lock:
+      return [(self.name, labels, (), value) for labels, value in self.values.items()]
+
+
+class Gauge:
+  kind = "gauge"
+
+  def __init__(self, name, help, label_names=()):
+    self.name = name
+    self.help = help
+    self.label_names = label_names
+    self.lock = threading.Lock()
+    # label values -> value
+    self.values = {}
+
+  def set(self, value, **labels):
+    key = tuple(str(labels[name]) for name in self.label_names)
+    with self.lock:
+      self.values[key] = value
+
+  def samples(self):
+    with self.lock:
+      return [(self.name, labels, (), value) for labels, value in self.values.items()]
+
+
+class Histogram:
+  kind = "histogram"
+
+  def __init__(self, name, help, label_names=()):
+    self.name = name
+    self.help = help
+    self.label_names = label_names
+    self.lock = threading.Lock()
+    # label values -> [count per bucket, sum, count]
+    self.values = {}
+
+  def observe(self, seconds, **labels):
+    key = tuple(str(labels[name]) for name in self.label_names)
+    with self.lock:
+      buckets, total, count = self.values.get(key, ([0] * len(BUCKETS), 0.0, 0))
+      for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+          buckets[i] += 1
+      self.values[key] = (buckets, total + seconds, count + 1)
+
+  def samples(self):
+    samples = []
+    with self.lock:
+      for labels, (buckets, total, count) in self.values.items():
+        for bound, bucket in zip(BUCKETS, buckets):
+          samples.append((f"{self.name}_bucket", labels, (("le", bound),), bucket))
+        samples.append((f"{self.name}_bucket", labels, (("le", "+Inf"),), count))
+        samples.append((f"{self.name}_sum", labels, (), total))
+        samples.append((f"{self.name}_count", labels, (), count))
+    return samples
+
+  # Returns {label values: (count, mean seconds)}.
+  def summary(self):
+    with self.lock:
+      return {
+          labels: (count, total / count if count else 0.0)
+          for labels, (_, total, count) in self.values.items()
+      }
+
+
+class Registry:
+  def __init__(self):
+    self.metrics = []
+
+  def register(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  # Renders every metric in the Prometheus text exposition format.
+  def render(self) -> str:
+    lines = []
+    for metric in self.metrics:
+      lines.append(f"# HELP {metric.name} {metric.help}")
+      lines.append(f"# TYPE {metric.name} {metric.kind}")
+      for name, labels, extra, value in metric.samples():
+        lines.append(f"{name}{format_labels(metric.label_names, labels, extra)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+api_requests = REGISTRY.register(Histogram(
+    "booko_api_request_seconds",
+    "Book API request latency.",
+    ("provider", "endpoint", "status")))
+api_retries = REGISTRY.register(Counter(
+    "booko_api_retries_total",
+    "Book API requests retried after an error or rate limiting.",
+    ("provider", "endpoint")))
+api_coalesced = REGISTRY.register(Counter(
+    "booko_api_coalesced_total",
+    "Book API lookups that waited on an identical lookup already in flight.",
+    ("provider", "method")))
+api_circuit_state = REGISTRY.register(Gauge(
+    "booko_api_circuit_state",
+    "Book API circuit breaker state: 0 closed, 1 half open, 2 open.",
+    ("provider",)))
+api_short_circuits = REGISTRY.register(Counter(
+    "booko_api_short_circuits_total",
+    "Book API requests refused by an open circuit breaker.",
+    ("provider",)))
+api_throttle = REGISTRY.register(Histogram(
+    "booko_api_throttle_seconds",
+    "Time book API requests waited on their provider's rate limit.",
+    ("provider",)))
+enrichment_lookups = REGISTRY.register(Counter(
+    "booko_enrichment_lookups_total",
+    "Lookups to fill in a book's missing fields, made or avoided because the search already answered.",
+    ("field", "outcome")))
+db_transactions = REGISTRY.register(Histogram(
+    "booko_db_transaction_seconds",
+    "Database transaction latency.",
+    ("engine", "outcome")))
+interactions = REGISTRY.register(Histogram(
+    "booko_interaction_seconds",
+    "Discord interaction callback latency.",
+    ("callback", "outcome")))
+
+
+# Records the latency and outcome of an interaction callback.
+def timed(callback):
+  def decorator(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+      start = time.perf_counter()
+      outcome = "error"
+      try:
+        result = await fn(*args, **kwargs)
+        outcome = "ok"
+        return result
+      finally:
+        interactions.observe(time.perf_counter() - start, callback=callback, outcome=outcome)
+    return wrapper
+  return decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path != "/metrics":
+      self.send_error(404)
+      return
+    payload = REGISTRY.render().encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def log_message(self, format, *args):
+    pass
+
+
+# Serves /metrics on localhost from a background thread.
+def serve(port):
+  server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
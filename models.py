@@ -1,9 +1,13 @@
 import argparse
+import metrics
 import sqlalchemy
 import enum
+import time
 
 
-from sqlalchemy import orm, Column, ForeignKey, Integer, String, Enum, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy import orm, and_, case, delete, func, BigInteger, Column, ForeignKey, Float, Index, Integer, String, Enum, select
+from sqlalchemy.dialects import postgresql, sqlite
 
 
 Base = orm.declarative_base()
@@ -19,12 +23,17 @@ class Rating(Base):
   __tablename__ = "ratings"
 
   id = Column(Integer, primary_key=True)
-  user_id = Column(Integer)
+  # Discord ids need 64 bits.
+  user_id = Column(BigInteger)
   book_id = Column(Integer, ForeignKey("books.id"))
   rating = Column(Integer)
 
   book = orm.relationship("Book", back_populates="ratings")
 
+  # Each user has at most one rating per book. book_id leads, so that loading a
+  # book's ratings uses the index too.
+  __table_args__ = (Index("ix_ratings_book_id_user_id", "book_id", "user_id", unique=True),)
+
   def __repr__(self):
     d = {
         "id":  self.id,
@@ -41,16 +50,28 @@ class Book(Base):
   id = Column(Integer, primary_key=True)
   title = Column(String)
   author = Column(String)
-  isbn = Column(String)
+  isbn = Column(String, index=True)
   open_library_url= Column(String)
   goodreads_url= Column(String)
   thumbnail_url = Column(String)
-  shelf = Column(Enum(Shelf))
-  message_id = Column(Integer)
-  user_id = Column(Integer)
+  shelf = Column(Enum(Shelf), index=True)
+  message_id = Column(BigInteger, index=True)
+  user_id = Column(BigInteger)
+  # When the refresh worker last revalidated the links, if ever.
+  refreshed_at = Column(Float, index=True)
 
   ratings = orm.relationship("Rating", order_by=Rating.id, back_populates="book")
 
+  # The fields that the book APIs fill in, as opposed to the bot's own state.
+  METADATA_FIELDS = ("title", "author", "isbn", "open_library_url", "goodreads_url", "thumbnail_url")
+
+  def to_dict(self):
+    return {field: getattr(self, field) for field in self.METADATA_FIELDS}
+
+  @classmethod
+  def from_dict(cls, d):
+    return cls(**{field: d.get(field) for field in cls.METADATA_FIELDS})
+
   def __repr__(self):
     d = {
         "id":  self.id,
@@ -66,15 +87,455 @@ class Book(Base):
     return f"Book{tuple(f'{k}={v}' for k, v in d.items())}"
 
 
+# Small pieces of bot state that should survive restarts.
+class BotState(Base):
+  __tablename__ = "bot_state"
+
+  key = Column(String, primary_key=True)
+  value = Column(String)
+
+  def __repr__(self):
+    return f"BotState('key={self.key}', 'value={self.value}')"
+
+
+# The display details of Discord users, so that embeds can be rendered without
+# the members intent.
+class User(Base):
+  __tablename__ = "users"
+
+  # The Discord user id.
+  id = Column(BigInteger, primary_key=True, autoincrement=False)
+  name = Column(String)
+  discriminator = Column(String)
+  avatar_url = Column(String)
+  updated_at = Column(Float)
+
+  @property
+  def mention(self) -> str:
+    return f"<@{self.id}>"
+
+  @property
+  def display_name(self) -> str:
+    return f"{self.name}#{self.discriminator}"
+
+  def __repr__(self):
+    d = {
+        "id": self.id,
+        "name": self.name,
+        "discriminator": self.discriminator,
+        "avatar_url": self.avatar_url,
+        "updated_at": self.updated_at,
+    }
+    return f"User{tuple(f'{k}={v}' for k, v in d.items())}"
+
+
+class CacheEntry(Base):
+  __tablename__ = "api_cache"
+
+  key = Column(String, primary_key=True)
+  # JSON encoded result. "null" is a cached negative result.
+  value = Column(String)
+  expires_at = Column(Float, index=True)
+  accessed_at = Column(Float, index=True)
+
+  def __repr__(self):
+    d = {
+        "key": self.key,
+        "value": self.value,
+        "expires_at": self.expires_at,
+        "accessed_at": self.accessed_at,
+    }
+    return f"CacheEntry{tuple(f'{k}={v}' for k, v in d.items())}"
+
+
+# How far an import of `source` has gotten, so that it can be resumed.
+class ImportCheckpoint(Base):
+  __tablename__ = "import_checkpoints"
+
+  source = Column(String, primary_key=True)
+  rows = Column(Integer)
+
+  def __repr__(self):
+    return f"ImportCheckpoint('source={self.source}', 'rows={self.rows}')"
+
+
+# Rating aggregates per book, kept up to date alongside every rating change so
+# that stats and leaderboards never have to scan the ratings table.
+class BookRatingStats(Base):
+  __tablename__ = "book_rating_stats"
+
+  book_id = Column(Integer, ForeignKey("books.id"), primary_key=True)
+  count = Column(Integer, default=0)
+  total = Column(Integer, default=0)
+  # The number of ratings of each value.
+  rated_1 = Column(Integer, default=0)
+  rated_2 = Column(Integer, default=0)
+  rated_3 = Column(Integer, default=0)
+  rated_4 = Column(Integer, default=0)
+  rated_5 = Column(Integer, default=0)
+  # The average rating, or NULL with no ratings.
+  score = Column(Float)
+
+  # Ordered so that the top books are the first entries of the index.
+  __table_args__ = (Index("ix_book_rating_stats_score_count", "score", "count"),)
+
+  def histogram(self):
+    return [self.rated_1, self.rated_2, self.rated_3, self.rated_4, self.rated_5]
+
+  def __repr__(self):
+    d = {
+        "book_id": self.book_id,
+        "count": self.count,
+        "total": self.total,
+        "histogram": self.histogram(),
+        "score": self.score,
+    }
+    return f"BookRatingStats{tuple(f'{k}={v}' for k, v in d.items())}"
+
+
+class UserRatingStats(Base):
+  __tablename__ = "user_rating_stats"
+
+  user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+  count = Column(Integer, default=0, index=True)
+  total = Column(Integer, default=0)
+
+  def __repr__(self):
+    return f"UserRatingStats('user_id={self.user_id}', 'count={self.count}', 'total={self.total}')"
+
+
+# The backend initialize() connected to, e.g. "sqlite" or "postgresql".
+backend = "sqlite"
+
+
+# Returns an INSERT for the backend's dialect, for its ON CONFLICT support.
+def dialect_insert(model):
+  return (postgresql.insert if backend == "postgresql" else sqlite.insert)(model)
+
+
+# Selects user_id's current rating of book_id.
+def select_rating(user_id: int, book_id: int):
+  return select(Rating.rating).where(Rating.user_id == user_id).where(Rating.book_id == book_id)
+
+
+# Sets `value` as user_id's rating of book_id, or clears it if it's already
+# their rating. The toggle is a single upsert, so concurrent clicks can't
+# create duplicate ratings; a cleared rating is left as NULL and removed by the
+# second statement in the same transaction. The upsert returns the new rating.
+def toggle_rating(user_id: int, book_id: int, value: int):
+  upsert = dialect_insert(Rating).values(user_id=user_id, book_id=book_id, rating=value)
+  upsert = upsert.on_conflict_do_update(
+      index_elements=[Rating.book_id, Rating.user_id],
+      set_={"rating": case((Rating.rating == upsert.excluded.rating, None), else_=upsert.excluded.rating)})
+  upsert = upsert.returning(Rating.rating)
+  cleanup = (
+      delete(Rating)
+      .where(Rating.user_id == user_id)
+      .where(Rating.book_id == book_id)
+      .where(Rating.rating.is_(None)))
+  return upsert, cleanup
+
+
+# Returns (statement, parameters) pairs which apply rating changes to the
+# aggregates. Each change is (book_id, user_id, old rating, new rating), where
+# either rating may be None. Changes are summed per book and per user first.
+def rating_stats_updates(changes):
+  books = {}
+  users = {}
+  for book_id, user_id, old, new in changes:
+    if old == new:
+      continue
+    book = books.setdefault(book_id, {"book_id": book_id, "count": 0, "total": 0, **{f"rated_{v}": 0 for v in range(1, 6)}})
+    user = users.setdefault(user_id, {"user_id": user_id, "count": 0, "total": 0})
+    for delta in (book, user):
+      delta["count"] += (new is not None) - (old is not None)
+      delta["total"] += (new or 0) - (old or 0)
+    if old is not None:
+      book[f"rated_{old}"] -= 1
+    if new is not None:
+      book[f"rated_{new}"] += 1
+
+  updates = []
+  if books:
+    for book in books.values():
+      book["score"] = book["total"] / book["count"] if book["count"] > 0 else None
+    upsert = dialect_insert(BookRatingStats)
+    counts = {
+        column: getattr(BookRatingStats, column) + getattr(upsert.excluded, column)
+        for column in ("count", "total", *(f"rated_{v}" for v in range(1, 6)))
+    }
+    counts["score"] = (
+        (BookRatingStats.total + upsert.excluded.total) * 1.0
+        / func.nullif(BookRatingStats.count + upsert.excluded.count, 0))
+    updates.append((upsert.on_conflict_do_update(index_elements=[BookRatingStats.book_id], set_=counts), list(books.values())))
+  if users:
+    upsert = dialect_insert(UserRatingStats)
+    counts = {
+        "count": UserRatingStats.count + upsert.excluded.count,
+        "total": UserRatingStats.total + upsert.excluded.total,
+    }
+    updates.append((upsert.on_conflict_do_update(index_elements=[UserRatingStats.user_id], set_=counts), list(users.values())))
+  return updates
+
+
+# Recomputes every rating aggregate from the ratings table.
+def rebuild_rating_stats(connection):
+  connection.execute(delete(BookRatingStats))
+  connection.execute(delete(UserRatingStats))
+  histogram = [func.sum(case((Rating.rating == v, 1), else_=0)) for v in range(1, 6)]
+  connection.execute(sqlalchemy.insert(BookRatingStats).from_select(
+      ["book_id", "count", "total", *(f"rated_{v}" for v in range(1, 6)), "score"],
+      select(
+          Rating.book_id, func.count(), func.sum(Rating.rating), *histogram, func.avg(Rating.rating))
+      .where(Rating.rating.is_not(None))
+      .group_by(Rating.book_id)))
+  connection.execute(sqlalchemy.insert(UserRatingStats).from_select(
+      ["user_id", "count", "total"],
+      select(Rating.user_id, func.count(), func.sum(Rating.rating))
+      .where(Rating.rating.is_not(None))
+      .group_by(Rating.user_id)))
+
+
+# Creates the named indexes of the models, if they don't exist. Migrations name
+# the indexes they add, since the models gain indexes on columns that only
+# later migrations add.
+def _create_indexes(connection, names):
+  indexes = {index.name: index for table in Base.metadata.sorted_tables for index in table.indexes}
+  for name in names:
+    indexes[name].create(connection, checkfirst=True)
+
+
+def _add_refreshed_at(connection):
+  columns = [column["name"] for column in sqlalchemy.inspect(connection).get_columns("books")]
+  if "refreshed_at" not in columns:
+    connection.exec_driver_sql("ALTER TABLE books ADD COLUMN refreshed_at FLOAT")
+  _create_indexes(connection, ("ix_books_refreshed_at",))
+
+
+def _index_ratings(connection):
+  # Keep only the latest of any duplicate ratings so the unique index applies.
+  connection.exec_driver_sql(
+      "DELETE FROM ratings WHERE id NOT IN "
+      "(SELECT MAX(id) FROM ratings GROUP BY user_id, book_id)")
+  _create_indexes(connection, (
+      "ix_ratings_book_id_user_id", "ix_books_isbn", "ix_books_shelf", "ix_books_message_id"))
+
+
+# Databases indexed by migration 1 before book_id led the ratings index.
+def _reindex_ratings(connection):
+  connection.exec_driver_sql("DROP INDEX IF EXISTS ix_ratings_user_id_book_id")
+  _create_indexes(connection, ("ix_ratings_book_id_user_id",))
+
+
+def _index_titles(connection):
+  # Other backends fall back to substring matches in search_books().
+  if connection.dialect.name != "sqlite":
+    return
+  # A full-text index over book titles and authors, kept up to date by
+  # triggers so that every insert and edit is indexed incrementally.
+  connection.exec_driver_sql(
+      "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts "
+      "USING fts5(title, author, content='books', content_rowid='id')")
+  connection.exec_driver_sql(
+      "CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN "
+      "INSERT INTO books_fts(rowid, title, author) VALUES (new.id, new.title, new.author); "
+      "END")
+  connection.exec_driver_sql(
+      "CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN "
+      "INSERT INTO books_fts(books_fts, rowid, title, author) "
+      "VALUES ('delete', old.id, old.title, old.author); "
+      "END")
+  connection.exec_driver_sql(
+      "CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN "
+      "INSERT INTO books_fts(books_fts, rowid, title, author) "
+      "VALUES ('delete', old.id, old.title, old.author); "
+      "INSERT INTO books_fts(rowid, title, author) VALUES (new.id, new.title, new.author); "
+      "END")
+  connection.exec_driver_sql("INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
+
+
+# (schema version, migration) pairs, applied in order to databases older than
+# the version. The version is tracked with SQLite's user_version pragma.
+MIGRATIONS = (
+    (1, _index_ratings),
+    (2, _index_titles),
+    (3, rebuild_rating_stats),
+    (4, _add_refreshed_at),
+    (5, _reindex_ratings),
+)
+
+
+books_fts = sqlalchemy.table("books_fts", sqlalchemy.column("rowid"), sqlalchemy.column("books_fts"), sqlalchemy.column("rank"))
+
+
+# Selects the top k books by average rating, with their titles.
+def top_books(k: int):
+  return (
+      select(Book, BookRatingStats)
+      .join(BookRatingStats, BookRatingStats.book_id == Book.id)
+      .where(BookRatingStats.score.is_not(None))
+      .order_by(BookRatingStats.score.desc(), BookRatingStats.count.desc())
+      .limit(k))
+
+
+def top_raters(k: int):
+  # Users whose ratings were all cleared keep a row with a zero count.
+  return (
+      select(UserRatingStats)
+      .where(UserRatingStats.count > 0)
+      .order_by(UserRatingStats.count.desc())
+      .limit(k))
+
+
+# Selects (Book, rating count, average rating) rows. The count and average come
+# from BookRatingStats rather than grouping the ratings.
+def books_with_ratings():
+  return (
+      select(Book, func.coalesce(BookRatingStats.count, 0), BookRatingStats.score)
+      .outerjoin(BookRatingStats, BookRatingStats.book_id == Book.id))
+
+
+# Selects the `limit` best full-text matches for query with their ratings, best
+# first. Every word is matched as a prefix. Without SQLite's FTS5, books whose
+# title or author contain every word are selected instead, unranked.
+def search_books(query: str, limit: int = 10):
+  if backend != "sqlite":
+    text = func.lower(Book.title + " " + Book.author)
+    words = (text.contains(word.lower(), autoescape=True) for word in query.split())
+    return books_with_ratings().where(and_(*words)).order_by(Book.id).limit(limit)
+
+  terms = " ".join('"' + word.replace('"', '""') + '"*' for word in query.split())
+  matches = (
+      select(books_fts.c.rowid, books_fts.c.rank)
+      .where(books_fts.c.books_fts.match(terms))
+      .order_by(books_fts.c.rank)
+      .limit(limit)
+      .subquery())
+  return (
+      books_with_ratings()
+      .join(matches, matches.c.rowid == Book.id)
+      .order_by(matches.c.rank))
+
+
+# SQLite databases keep their schema version in user_version; other backends
+# keep it in bot_state.
+def schema_version(connection) -> int:
+  if connection.dialect.name == "sqlite":
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+  version = connection.execute(select(BotState.value).where(BotState.key == "schema_version")).scalar()
+  return int(version or 0)
+
+
+def set_schema_version(connection, version: int):
+  if connection.dialect.name == "sqlite":
+    connection.exec_driver_sql(f"PRAGMA user_version = {version}")
+    return
+  upsert = dialect_insert(BotState).values(key="schema_version", value=str(version))
+  connection.execute(upsert.on_conflict_do_update(index_elements=[BotState.key], set_={"value": upsert.excluded.value}))
+
+
+def migrate(engine):
+  with engine.begin() as connection:
+    version = schema_version(connection)
+    for target, migration in MIGRATIONS:
+      if version < target:
+        print(f"Migrating database to schema version {target}...")
+        migration(connection)
+        set_schema_version(connection, target)
+
+
+# Records how long each transaction on engine takes in metrics.
+def time_transactions(engine, name):
+  def begin(connection):
+    connection.info["transaction_start"] = time.perf_counter()
+
+  def end(connection, outcome):
+    start = connection.info.pop("transaction_start", None)
+    if start is not None:
+      metrics.db_transactions.observe(time.perf_counter() - start, engine=name, outcome=outcome)
+
+  sqlalchemy.event.listen(engine, "begin", begin)
+  sqlalchemy.event.listen(engine, "commit", lambda connection: end(connection, "commit"))
+  sqlalchemy.event.listen(engine, "rollback", lambda connection: end(connection, "rollback"))
+
+
+# Applied to every new SQLite connection. WAL lets readers carry on while a
+# writer commits, and NORMAL sync is still safe from corruption in WAL mode.
+# Writers wait up to busy_timeout ms for each other rather than failing with
+# "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    # Negative sizes are in KiB.
+    "cache_size": -64 * 1024,
+}
+
+# The asyncio driver for each backend.
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+}
+
+
+def apply_pragmas(engine, pragmas):
+  def connect(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+      cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+  sqlalchemy.event.listen(engine, "connect", connect)
+
+
+# Drops the queue pool settings when url gets another kind of pool, e.g. the
+# single connection pools of in-memory SQLite databases, which reject them.
+def pool_options(url, pool):
+  if issubclass(url.get_dialect().get_pool_class(url), sqlalchemy.pool.QueuePool):
+    return pool
+  return {key: value for key, value in pool.items() if key not in ("pool_size", "max_overflow", "pool_timeout")}
+
+
 Session = None
+# Sessions for use from coroutines, e.g. the bot, so that database work doesn't
+# block the event loop.
+AsyncSession = None
+
+# database is a SQLAlchemy URL, e.g. postgresql://user@host/booko, or the path
+# of a SQLite database. The pool settings apply to both the sync and async
+# engines.
+def initialize(
+    database, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=30*60, pragmas=SQLITE_PRAGMAS):
+  global Session, AsyncSession, backend
 
-def initialize(database):
-  global Session
+  url = sqlalchemy.engine.make_url(database if "://" in database else f"sqlite:///{database}")
+  backend = url.get_backend_name()
+  pool = {
+      "pool_size": pool_size,
+      "max_overflow": max_overflow,
+      "pool_timeout": pool_timeout,
+      "pool_recycle": pool_recycle,
+      # Replace connections the server dropped while they were idle.
+      "pool_pre_ping": backend != "sqlite",
+  }
 
-  engine = sqlalchemy.create_engine(f"sqlite:///{database}", future=True)
+  engine = sqlalchemy.create_engine(url, future=True, **pool_options(url, pool))
+  if backend == "sqlite":
+    apply_pragmas(engine, pragmas)
   Base.metadata.create_all(engine)
+  migrate(engine)
+  time_transactions(engine, "sync")
   Session = orm.sessionmaker(engine)
 
+  async_url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+  async_engine = create_async_engine(async_url, **pool_options(async_url, pool))
+  if backend == "sqlite":
+    apply_pragmas(async_engine.sync_engine, pragmas)
+  time_transactions(async_engine.sync_engine, "async")
+  # Objects outlive their sessions in the bot, so don't expire them on commit.
+  AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
 
 def main():
   initialize("data/test_alchemy.db")
@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import contextvars
+import itertools
+import json
+import sys
+import threading
+import time
+import traceback
+
+
+from metrics import percentile
+
+
+# The open span of the current task, if any.
+current_span = contextvars.ContextVar("current_span", default=None)
+
+# Set by enable(); spans and stalls are only recorded when profiling.
+tracer = None
+
+
+# Appends trace records to a JSONL file.
+class Tracer:
+  def __init__(self, path):
+    self.file = open(path, "a")
+    self.lock = threading.Lock()
+    self.ids = itertools.count(1)
+
+  def write(self, record):
+    with self.lock:
+      self.file.write(json.dumps(record) + "\n")
+      self.file.flush()
+
+  def close(self):
+    with self.lock:
+      self.file.close()
+
+
+# Records the enclosed block as a span, nested under the current task's open
+# span. Spans with no parent start a new trace.
+@contextlib.contextmanager
+def span(name, **attributes):
+  if not tracer:
+    yield
+    return
+
+  parent = current_span.get()
+  record = {
+      "type": "span",
+      "name": name,
+      "id": next(tracer.ids),
+      "parent": parent["id"] if parent else None,
+      "trace": parent["trace"] if parent else None,
+      "start": time.time(),
+      **attributes,
+  }
+  if record["trace"] is None:
+    record["trace"] = record["id"]
+
+  token = current_span.set(record)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    record["duration"] = time.perf_counter() - start
+    current_span.reset(token)
+    tracer.write(record)
+
+
+# Measures event loop lag with a heartbeat task. A watchdog thread notices when
+# the heartbeat is late by more than threshold seconds and captures the stack
+# of whatever is holding the loop, which is written out once the loop frees up.
+class LoopMonitor:
+  def __init__(self, threshold=0.1, interval=0.05):
+    self.threshold = threshold
+    self.interval = interval
+    self.last_beat = time.monotonic()
+    self.stack = None
+    self.stopped = threading.Event()
+
+  def start(self):
+    self.loop_thread_id = threading.get_ident()
+    self.task = asyncio.create_task(self.heartbeat())
+    threading.Thread(target=self.watchdog, daemon=True).start()
+
+  def stop(self):
+    self.stopped.set()
+    self.task.cancel()
+
+  async def heartbeat(self):
+    while True:
+      self.last_beat = time.monotonic()
+      await asyncio.sleep(self.interval)
+      lag = time.monotonic() - self.last_beat - self.interval
+      if lag > self.threshold:
+        stack, self.stack = self.stack, None
+        tracer.write({"type": "stall", "start": time.time() - lag, "duration": lag, "stack": stack})
+
+  def watchdog(self):
+    while not self.stopped.wait(self.interval):
+      late = time.monotonic() - self.last_beat - self.interval
+      if late > self.threshold and self.stack is None:
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame:
+          self.stack = traceback.format_stack(frame)
+
+
+def enable(path, threshold):
+  global tracer
+  tracer = Tracer(path)
+  monitor = LoopMonitor(threshold)
+  monitor.start()
+  return monitor
+
+
+# Prints the longest stalls and the slowest spans in a trace file.
+def summarize(path, top):
+  stalls = []
+  spans = collections.defaultdict(list)
+  with open(path, "r") as f:
+    for line in f:
+      record = json.loads(line)
+      if record["type"] == "stall":
+        stalls.append(record)
+      else:
+        spans[record["name"]].append(record["duration"])
+
+  stalls.sort(key=lambda stall: stall["duration"], reverse=True)
+  print(f"{len(stalls)} event loop stalls. Longest:")
+  for stall in stalls[:top]:
+    print(f"\n{stall['duration'] * 1000:.1f}ms at {time.ctime(stall['start'])}")
+    # The innermost frames are the most telling.
+    print("".join((stall["stack"] or ["  (no stack captured)\n"])[-5:]), end="")
+
+  print("\nSpans by worst p95:")
+  rows = []
+  for name, durations in spans.items():
+    durations.sort()
+    rows.append((percentile(durations, .95), name, durations))
+  for p95, name, durations in sorted(rows, reverse=True)[:top]:
+    print(
+        f"{name:<24} n={len(durations):<6} p50={percentile(durations, .5) * 1000:8.1f}ms "
+        f"p95={p95 * 1000:8.1f}ms max={durations[-1] * 1000:8.1f}ms")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Summarizes a booko --profile trace.")
+  parser.add_argument("trace", help="The JSONL trace file.")
+  parser.add_argument("--top", type=int, default=10, help="How many offenders to show.")
+  args = parser.parse_args()
+  summarize(args.trace, args.top)
+
+
+if __name__ == "__main__":
+  main()